@@ -60,16 +60,16 @@ class Agent:
         system, user = get_codedb_query_generation_prompt(enhanced_query, readme, SEARCH_SENTENCES)
         response = self.large_llm.prompt(system, user)
         search_sentences = get_content(response, "search_sentences").strip().split(sep_token)
-        search_results: list[QueryResult] = []
-        for search_sentence in search_sentences:
-            search_results.extend(self.codedb.search(search_sentence, 8))
-        search_results.sort(key=lambda q: q.score, reverse=True)
+        # the question itself goes along, its identifiers are found by the full text half of the search
+        search_results: list[QueryResult] = self.codedb.search_many(search_sentences + [q.query], 8, hybrid=True)
         search_results = _unique_by_key(search_results, key=lambda r: f"{r.rec.path}:{r.rec.name}")[:RETRIEVE_N]
         codes = map(
             lambda x: x.rec,
             search_results
         )
 
+        dependencies = self._dependencies(map(lambda r: r.rec.path, search_results))
+
         q.set_status(QueryStatus.ANSWERING)
 
         system, user = get_answer_generation_prompt(
@@ -77,7 +77,8 @@ class Agent:
             output_format,
             readme,
             self.codedb.directories,
-            codes
+            codes,
+            dependencies
         )
         response = self.large_llm.prompt(system, user, temperature=0.3)
         answer = get_content(response, "answer")
@@ -96,6 +97,20 @@ class Agent:
             }, search_results))
         }
 
+    def _dependencies(self, paths: Iterable[str], limit: int = 8) -> list[str]:
+        """What the files of the retrieved snippets import and are imported by, from the stored import graph."""
+        graph = self.codedb.import_graph
+        if graph is None:
+            return []
+        importers = graph.importers()
+        lines = []
+        for path in _unique_by_key(paths):
+            imports = sorted(graph.imports.get(path, set()))[:limit]
+            imported_by = sorted(importers.get(path, set()))[:limit]
+            if imports or imported_by:
+                lines.append(f"{path} imports [{', '.join(imports)}], imported by [{', '.join(imported_by)}]")
+        return lines
+
     def _bulk_prompt(self, prompts: Iterable[tuple[str, str]], use_large=False, threads: int = 16) -> Iterable[str]:
         def prompt(prompt: tuple[str, str]) -> str:
             n_tokens = count_tokens_prompt(*prompt)
@@ -0,0 +1,519 @@
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+import json
+from pathlib import Path
+
+def _measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, current, peak
+
+def _report(name: str, elapsed: float, current: int, peak: int):
+    print(f"{name:<28} {elapsed:8.2f}s  retained {current / 2**20:8.1f} MiB  peak {peak / 2**20:8.1f} MiB")
+
+class _NullWriter:
+    def __init__(self):
+        self.bytes = 0
+    def write(self, s: str):
+        self.bytes += len(s)
+
+def _make_synthetic_tree(root: str, files: int, files_per_dir: int = 100, fanout: int = 10):
+    """`files` empty .py files spread over a balanced directory tree."""
+    dirs = [root]
+    n_dirs = max(1, files // files_per_dir)
+    i = 0
+    while len(dirs) < n_dirs:
+        d = os.path.join(dirs[i], f"pkg_{len(dirs) % fanout}_{len(dirs)}")
+        os.mkdir(d)
+        dirs.append(d)
+        if len(dirs) % fanout == 0:
+            i += 1
+    for n in range(files):
+        open(os.path.join(dirs[n % len(dirs)], f"module_{n}.py"), "w").close()
+
+def bench_tree(args):
+    from repo import RepoFile
+    from repotree import RepoTree
+
+    with tempfile.TemporaryDirectory() as root:
+        print(f"creating {args.files} files under {root}")
+        _make_synthetic_tree(root, args.files)
+
+        def legacy():
+            return json.dumps(RepoFile(Path(root)).to_dict())
+        s, elapsed, current, peak = _measure(legacy)
+        _report("RepoFile.to_dict + dumps", elapsed, current, peak)
+        legacy_len = len(s)
+        del s
+
+        def compact_build():
+            return RepoTree.from_path(root)
+        tree, elapsed, current, peak = _measure(compact_build)
+        _report("RepoTree.from_path", elapsed, current, peak)
+
+        def compact_dump():
+            w = _NullWriter()
+            tree.write_json(w)
+            return w.bytes
+        n, elapsed, current, peak = _measure(compact_dump)
+        _report("RepoTree.write_json", elapsed, current, peak)
+        print(f"json size legacy {legacy_len} bytes, streamed {n} bytes")
+
+def _synthetic_module(n: int, classes: int = 5, methods: int = 8) -> str:
+    lines = ["import os", "from typing import Optional", ""]
+    for c in range(classes):
+        lines.append(f"class Class{n}_{c}:")
+        for m in range(methods):
+            lines += [
+                f"    def method_{m}(self, x: int, y: Optional[int] = None) -> int:",
+                f"        \"\"\"Method {m} of class {c}.\"\"\"",
+                "        total = 0",
+                "        for i in range(x):",
+                "            if i % 2 == 0:",
+                "                total += i * (y or 1)",
+                "        return total",
+                "",
+            ]
+    return "\n".join(lines)
+
+class _SyntheticRepo:
+    """Just enough of Repository for parse(): an index over a directory and an ignore engine."""
+    def __init__(self, root: str):
+        from repo import RepoIndex
+        from ignore import IgnoreEngine
+        self.index = RepoIndex.from_path(Path(root))
+        self.ignore = IgnoreEngine([])
+
+def bench_parse(args):
+    from parsing import parse
+
+    with tempfile.TemporaryDirectory() as root:
+        print(f"creating {args.files} modules under {root}")
+        for n in range(args.files):
+            d = os.path.join(root, f"pkg_{n % 100}")
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, f"module_{n}.py"), "w") as f:
+                f.write(_synthetic_module(n))
+        repo = _SyntheticRepo(root)
+
+        base = None
+        for processes in args.processes:
+            start = time.perf_counter()
+            chunks = parse(repo, processes=processes, batch_bytes=args.batch_bytes)
+            elapsed = time.perf_counter() - start
+            base = base or elapsed
+            print(f"processes {processes:3d}: {elapsed:8.2f}s  speedup {base / elapsed:5.2f}x  ({len(chunks)} files)")
+
+def _legacy_extract(node, out: list):
+    # recursive walk copying every definition through node.text, as parse_source used to
+    if node.type in ("class_definition", "function_definition", "decorated_definition"):
+        d = node.child_by_field_name("definition") or node
+        out.append((d.child_by_field_name("name").text.decode(), node.text.decode()))
+        if d.type == "class_definition":
+            for child in d.child_by_field_name("body").children:
+                _legacy_extract(child, out)
+        return
+    for child in node.children:
+        _legacy_extract(child, out)
+
+def _deep_module(depth: int) -> str:
+    lines = []
+    for d in range(depth):
+        lines.append("    " * d + f"if x > {d}:")
+    lines.append("    " * depth + "def leaf(self):")
+    lines.append("    " * depth + "    return 0")
+    return "\n".join(lines)
+
+def bench_extract(args):
+    from parsing import _parser, _extract
+    from sourcestore import SourceStore
+
+    sources = {
+        "large": "\n".join(_synthetic_module(n) for n in range(args.modules)).encode(),
+        "deep": _deep_module(args.depth).encode(),
+    }
+    for kind, code in sources.items():
+        tree = _parser.parse(code)
+        print(f"{kind}: {len(code) / 2**20:.1f} MiB of source, extraction from a parsed tree")
+
+        def legacy():
+            out = []
+            _legacy_extract(tree.root_node, out)
+            return out
+        try:
+            _, elapsed, current, peak = _measure(legacy)
+            _report("  recursive node.text", elapsed, current, peak)
+        except RecursionError:
+            print("  recursive node.text        RecursionError")
+
+        def cursor():
+            chunk = _extract(tree, code, kind, kind)
+            store = SourceStore()
+            store.add_codes([chunk])
+            out = []
+            for c in chunk.classes:
+                out.append((c.name, store.text(c.span)))
+                out += [(f.name, store.text(f.span)) for f in c.methods]
+            return out + [(f.name, store.text(f.span)) for f in chunk.functions]
+        _, elapsed, current, peak = _measure(cursor)
+        _report("  cursor + lazy bodies", elapsed, current, peak)
+
+def _synthetic_descriptions(n: int, seed: int = 0) -> list[str]:
+    # descriptions range from a short sentence to a long paragraph, like LLM and cheap descriptions mixed
+    import random
+    rng = random.Random(seed)
+    words = "function class returns list dict parses reads writes cache redis index token batch file path".split()
+    return [" ".join(rng.choice(words) for _ in range(rng.choice([8, 16, 32, 64, 128, 256]))) for _ in range(n)]
+
+def _padding(lengths: list[int], batch_size: int) -> float:
+    """Padded tokens per real token when `lengths` are batched in the given order."""
+    padded = sum(max(lengths[i:i + batch_size]) * len(lengths[i:i + batch_size]) for i in range(0, len(lengths), batch_size))
+    return padded / sum(lengths)
+
+def bench_embed(args):
+    import numpy as np
+    from embedder import Embedder
+
+    texts = _synthetic_descriptions(args.texts)
+    embedder = Embedder.from_env()
+    embedder.model.encode(texts[:8])    # warm up
+    lengths = embedder.lengths(texts)
+    # token counts in the order iter_encode batches them, by character length
+    sorted_lengths = [lengths[i] for i in sorted(range(len(texts)), key=lambda i: -len(texts[i]))]
+    print(f"{len(texts)} descriptions, {sum(lengths) / len(lengths):.0f} tokens on average, CPU threads {os.cpu_count()}")
+
+    def legacy():
+        return embedder.model.encode(texts, precision="float32").astype(np.float32).tolist()
+    _, elapsed, current, peak = _measure(legacy)
+    _report("encode all + tolist", elapsed, current, peak)
+    print(f"{'':<28} {len(texts) / elapsed:8.1f} texts/s")
+
+    for batch_size in args.batch_sizes:
+        embedder.batch_size = batch_size
+        def batched():
+            n = 0
+            for _, embeddings in embedder.iter_encode(texts):
+                n += len(embeddings)
+            return n
+        _, elapsed, current, peak = _measure(batched)
+        _report(f"length sorted, batch {batch_size}", elapsed, current, peak)
+        print(
+            f"{'':<28} {len(texts) / elapsed:8.1f} texts/s  padding {_padding(lengths, batch_size):.2f}x "
+            f"unsorted, {_padding(sorted_lengths, batch_size):.2f}x sorted"
+        )
+
+_STARTUP_SCRIPTS = {
+    # what CodeDB.__init__ used to do
+    "eager model load": """
+from sentence_transformers import SentenceTransformer
+SentenceTransformer("sentence-transformer")
+""",
+    "lazy embedder": """
+import codedb
+from embedder import get_embedder
+get_embedder()
+""",
+    "lazy + first query": """
+import codedb
+from embedder import get_embedder
+get_embedder().encode(["how are repositories cloned"])
+""",
+}
+
+def bench_startup(args):
+    import subprocess
+    import sys
+
+    for name, script in _STARTUP_SCRIPTS.items():
+        timed = "import sys, time\nstart = time.perf_counter()\n" + script + \
+            "print(time.perf_counter() - start, 'torch' in sys.modules)\n"
+        runs = []
+        for _ in range(args.runs):
+            out = subprocess.run([sys.executable, "-c", timed], capture_output=True, text=True, check=True)
+            elapsed, torch = out.stdout.split()[-2:]
+            runs.append(float(elapsed))
+        print(f"{name:<28} {min(runs):8.2f}s best of {args.runs}  torch imported: {torch}")
+
+def bench_onnx(args):
+    import statistics
+    import sys
+    import numpy as np
+    from embedder import Embedder, OnnxEmbedder
+
+    texts = _synthetic_descriptions(args.texts)
+    queries = _synthetic_descriptions(args.queries, seed=1)
+    backends = {
+        "torch fp32": Embedder.from_env(),
+        f"onnx int8 {OnnxEmbedder.from_env().quantization}": OnnxEmbedder.from_env(),
+    }
+    embeddings = {}
+    for name, embedder in backends.items():
+        embedder.encode(texts[:8])    # load and warm up
+        start = time.perf_counter()
+        embeddings[name] = embedder.encode(texts)
+        elapsed = time.perf_counter() - start
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            embedder.encode([query])
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print(
+            f"{name:<28} build {len(texts) / elapsed:8.1f} texts/s  "
+            f"query p50 {1000 * statistics.median(latencies):6.1f} ms  p95 {1000 * latencies[int(0.95 * (len(latencies) - 1))]:6.1f} ms"
+        )
+
+    # parity: the int8 model must keep the geometry of the index built by the fp32 one
+    a, b = embeddings.values()
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    print(f"cosine fp32 vs int8: min {cosine.min():.4f}  mean {cosine.mean():.4f}")
+    if cosine.min() < args.min_cosine:
+        print(f"parity FAILED, {(cosine < args.min_cosine).sum()} embeddings below {args.min_cosine}")
+        sys.exit(1)
+    print("parity ok")
+
+def _clustered_vectors(n: int, dim: int, clusters: int = 256, seed: int = 0):
+    # embeddings of code descriptions are clustered, uniform random vectors would understate recall
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def bench_vector(args):
+    import statistics
+    from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+    from redis.commands.search.query import Query
+    from common.redis import get_redis
+    from vectorindex import VectorIndexConfig
+
+    redis = get_redis()
+    prefix = "bench:vector:"
+    vectors = _clustered_vectors(args.records + args.queries, args.dim)
+    vectors, queries = vectors[:args.records], vectors[args.records:]
+
+    print(f"loading {args.records} records of {args.dim} dimensions")
+    pipeline = redis.pipeline(transaction=False)
+    for i, vector in enumerate(vectors):
+        pipeline.hset(f"{prefix}doc:{i}", mapping={"embedding": vector.tobytes()})
+        if i % 1000 == 999:
+            pipeline.execute()
+    pipeline.execute()
+
+    def search(index, vector, k: int, ef: int = 0) -> tuple[list[str], float]:
+        ef = f" EF_RUNTIME {ef}" if ef else ""
+        query = Query(f"(*)=>[KNN {k} @embedding $query_vector{ef} AS score]").sort_by("score").return_fields("score").dialect(2)
+        start = time.perf_counter()
+        docs = index.search(query, {"query_vector": vector.tobytes()}).docs
+        return [doc.id for doc in docs], time.perf_counter() - start
+
+    def report(name: str, latencies: list[float], recall: float):
+        latencies = sorted(latencies)
+        print(
+            f"{name:<28} recall@{args.k} {recall:6.3f}  p50 {1000 * statistics.median(latencies):6.2f} ms  "
+            f"p95 {1000 * latencies[int(0.95 * (len(latencies) - 1))]:6.2f} ms"
+        )
+
+    indexes = {}
+    try:
+        for algorithm in ("flat", "hnsw"):
+            config = VectorIndexConfig(algorithm, args.m, args.ef_construction)
+            index = redis.ft(f"{prefix}{algorithm}")
+            start = time.perf_counter()
+            index.create_index(
+                fields=(config.field("embedding", args.dim, args.records),),
+                definition=IndexDefinition(prefix=[f"{prefix}doc:"], index_type=IndexType.HASH)
+            )
+            while int(index.info()["indexing"]):
+                time.sleep(0.1)
+            indexes[algorithm] = index
+            print(f"{algorithm} index built in {time.perf_counter() - start:.1f}s")
+
+        exact = []
+        latencies = []
+        for vector in queries:
+            ids, elapsed = search(indexes["flat"], vector, args.k)
+            exact.append(set(ids))
+            latencies.append(elapsed)
+        report("flat", latencies, 1.0)
+
+        for ef in args.ef_runtime:
+            found = 0
+            latencies = []
+            for vector, truth in zip(queries, exact):
+                ids, elapsed = search(indexes["hnsw"], vector, args.k, ef)
+                found += len(truth & set(ids))
+                latencies.append(elapsed)
+            report(f"hnsw M {args.m} ef {ef}", latencies, found / (args.k * len(queries)))
+    finally:
+        for index in indexes.values():
+            index.dropindex(delete_documents=False)
+        for key in redis.scan_iter(f"{prefix}*"):
+            redis.delete(key)
+
+def bench_storage(args):
+    from common.redis import get_redis
+    from vectorindex import pack
+
+    redis = get_redis()
+    prefix = "bench:storage:"
+    vectors = _clustered_vectors(args.records, args.dim)
+    descriptions = _synthetic_descriptions(args.records)
+    body = _synthetic_module(0, classes=1, methods=2)
+
+    def record(i: int) -> dict:
+        return {
+            "type": "function", "path": f"pkg/module_{i % 500}.py", "name": f"function_{i}",
+            "body": body, "description": descriptions[i], "hash": f"{i:040x}", "parent": "",
+            "start_line": 1, "end_line": 20,
+        }
+
+    def json_layout(pipeline, key: str, fields: dict):
+        pipeline.json().set(key, "$", fields)
+
+    def hash_layout(pipeline, key: str, fields: dict):
+        pipeline.hset(key, mapping=fields)
+
+    # (how vectors are converted, how a record is written), the first is the layout before blobs
+    layouts = {
+        "json float list": (lambda: [vector.tolist() for vector in vectors], json_layout),
+        "hash FLOAT32 blob": (lambda: pack(vectors, "FLOAT32"), hash_layout),
+        "hash FLOAT16 blob": (lambda: pack(vectors, "FLOAT16"), hash_layout),
+    }
+    print(f"{args.records} records of {args.dim} dimensions")
+    try:
+        for name, (convert, write) in layouts.items():
+            for key in redis.scan_iter(f"{prefix}*"):
+                redis.delete(key)
+            before = redis.info("memory")["used_memory"]
+            start = time.perf_counter()
+            converted = convert()
+            pipeline = redis.pipeline(transaction=False)
+            for i in range(args.records):
+                write(pipeline, f"{prefix}{i}", {**record(i), "embedding": converted[i]})
+                if i % 1000 == 999:
+                    pipeline.execute()
+            pipeline.execute()
+            elapsed = time.perf_counter() - start
+            used = redis.info("memory")["used_memory"] - before
+            print(f"{name:<28} {args.records / elapsed:8.0f} records/s  {used / args.records:8.0f} bytes/record")
+    finally:
+        for key in redis.scan_iter(f"{prefix}*"):
+            redis.delete(key)
+
+class _IndexedRepo:
+    """Just enough of Repository for CodeDB to read an index that is already built."""
+    def __init__(self, id: str):
+        self.id = id
+
+def _labelled_queries(codedb, samples: int, seed: int = 0) -> list[dict]:
+    # questions naming a definition, the failure case of pure KNN, labelled with that definition
+    import random
+    keys = list(codedb.redis.scan_iter(f"{codedb._codechunk_prefix}*"))
+    pipeline = codedb.redis.pipeline()
+    for key in keys:
+        pipeline.hmget(key, ("type", "path", "name"))
+    recs = [(path, name) for type, path, name in pipeline.execute() if type in ("function", "class", "method")]
+    rng = random.Random(seed)
+    return [
+        {"query": f"how does {name.split('.')[-1]} work", "expected": [f"{path}:{name}"]}
+        for path, name in rng.sample(recs, min(samples, len(recs)))
+    ]
+
+def bench_retrieval(args):
+    import statistics
+    from codedb import CodeDB
+
+    codedb = CodeDB(_IndexedRepo(args.repo_id))
+    if args.queries:
+        with open(args.queries) as f:
+            labelled = json.load(f)     # [{"query": ..., "expected": ["path:name", ...]}, ...]
+    else:
+        labelled = _labelled_queries(codedb, args.samples)
+    print(f"{len(labelled)} labelled queries against {args.repo_id}")
+    codedb.search("warm up")
+
+    for name, hybrid in (("knn", False), ("hybrid bm25 + knn", True)):
+        hits = 0
+        reciprocal = 0.0
+        latencies = []
+        for item in labelled:
+            start = time.perf_counter()
+            results = codedb.search_many([item["query"]], args.k, hybrid=hybrid)[:args.k]
+            latencies.append(time.perf_counter() - start)
+            found = [f"{r.rec.path}:{r.rec.name}" for r in results]
+            ranks = [found.index(e) + 1 for e in item["expected"] if e in found]
+            if ranks:
+                hits += 1
+                reciprocal += 1 / min(ranks)
+        latencies.sort()
+        print(
+            f"{name:<28} hit@{args.k} {hits / len(labelled):6.3f}  MRR {reciprocal / len(labelled):6.3f}  "
+            f"p50 {1000 * statistics.median(latencies):6.1f} ms  p95 {1000 * latencies[int(0.95 * (len(latencies) - 1))]:6.1f} ms"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="analyzer benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("tree", help="memory of the repository tree and its JSON serialization")
+    p.add_argument("--files", type=int, default=100*1000)
+    p.set_defaults(fn=bench_tree)
+
+    p = sub.add_parser("parse", help="serial vs process pool parsing")
+    p.add_argument("--files", type=int, default=20*1000)
+    p.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    p.add_argument("--batch-bytes", type=int, default=256*1024)
+    p.set_defaults(fn=bench_parse)
+
+    p = sub.add_parser("extract", help="recursive node.text vs cursor based extraction")
+    p.add_argument("--modules", type=int, default=2000, help="synthetic modules concatenated into the large file")
+    p.add_argument("--depth", type=int, default=2000, help="nesting depth of the deep file")
+    p.set_defaults(fn=bench_extract)
+
+    p = sub.add_parser("embed", help="embedding throughput by batch size, length sorted vs one call")
+    p.add_argument("--texts", type=int, default=4000)
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[8, 16, 32, 64, 128])
+    p.set_defaults(fn=bench_embed)
+
+    p = sub.add_parser("startup", help="process start-up with an eager vs lazily loaded embedding model")
+    p.add_argument("--runs", type=int, default=3)
+    p.set_defaults(fn=bench_startup)
+
+    p = sub.add_parser("onnx", help="int8 ONNX vs fp32 torch embeddings: parity, build throughput, query latency")
+    p.add_argument("--texts", type=int, default=2000)
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--min-cosine", type=float, default=0.98)
+    p.set_defaults(fn=bench_onnx)
+
+    p = sub.add_parser("vector", help="FLAT vs HNSW index: recall@k against FLAT and query latency, needs redis")
+    p.add_argument("--records", type=int, default=200*1000)
+    p.add_argument("--queries", type=int, default=500)
+    p.add_argument("--dim", type=int, default=384)
+    p.add_argument("--k", type=int, default=8)
+    p.add_argument("--m", type=int, default=16)
+    p.add_argument("--ef-construction", type=int, default=200)
+    p.add_argument("--ef-runtime", type=int, nargs="+", default=[16, 32, 64, 128, 256])
+    p.set_defaults(fn=bench_vector)
+
+    p = sub.add_parser("storage", help="JSON float lists vs HASH FLOAT32/FLOAT16 blobs: redis memory and ingest rate, needs redis")
+    p.add_argument("--records", type=int, default=50*1000)
+    p.add_argument("--dim", type=int, default=384)
+    p.set_defaults(fn=bench_storage)
+
+    p = sub.add_parser("retrieval", help="hit rate and latency of KNN vs hybrid search on labelled queries, needs a built index")
+    p.add_argument("repo_id", help="id of a repository indexed in redis")
+    p.add_argument("--queries", help="JSON list of {query, expected: [path:name]}, default: questions naming sampled definitions")
+    p.add_argument("--samples", type=int, default=200)
+    p.add_argument("--k", type=int, default=8)
+    p.set_defaults(fn=bench_retrieval)
+
+    args = parser.parse_args()
+    args.fn(args)
@@ -0,0 +1,59 @@
+import math
+import re
+from typing import Optional
+
+TEST_DIRS = {"test", "tests", "testing", "examples", "example", "benchmarks", "scripts", "docs"}
+_DOCSTRING = re.compile(r'^\s*[rRbBuU]?("""|\'\'\')\s*(.*?)\s*(?:\1|$)', re.MULTILINE | re.DOTALL)
+
+def is_test_path(path: str) -> bool:
+    parts = path.split("/")
+    name = parts[-1]
+    return any(p in TEST_DIRS for p in parts[:-1]) \
+        or name.startswith("test_") or name.endswith("_test.py") or name == "conftest.py"
+
+def score(path: str, name: str, fan_in: int) -> float:
+    """Value of describing a definition: imported, public, shallow, non-test code first."""
+    s = 1.0 + math.log1p(fan_in)
+    if name.startswith("_") and not name.startswith("__"):
+        s *= 0.5
+    if is_test_path(path):
+        s *= 0.25
+    return s / (1.0 + 0.25 * path.count("/"))
+
+def cheap_description(type: str, path: str, name: str, body: str) -> str:
+    """Description built from the code alone, for definitions the budget does not cover."""
+    lines = body.lstrip().splitlines()
+    signature = ""
+    for line in lines:
+        if not line.lstrip().startswith("@"):
+            signature = line.strip().rstrip(":")
+            break
+    description = f"{type.capitalize()} '{name}' defined in {path}: {signature}."
+    match = _DOCSTRING.search(body)
+    if match and match.group(2):
+        description += " " + match.group(2).strip().splitlines()[0]
+    return description
+
+class TokenBudget:
+    """Input tokens we are allowed to send to the LLM during one build, None means unlimited."""
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+        self.used = 0
+        self.described = 0
+        self.skipped = 0
+
+    def consume(self, tokens: int) -> bool:
+        if self.limit is not None and self.used + tokens > self.limit:
+            self.skipped += 1
+            return False
+        self.used += tokens
+        self.described += 1
+        return True
+
+    def summary(self) -> str:
+        limit = "unlimited" if self.limit is None else f"{self.limit}"
+        usage = "" if not self.limit else f" ({100 * self.used / self.limit:.1f}%)"
+        return (
+            f"token budget: used {self.used} / {limit} tokens{usage}, "
+            f"{self.described} records described by LLM, {self.skipped} on the cheap path"
+        )
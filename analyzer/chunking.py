@@ -0,0 +1,131 @@
+from typing import Union
+from tree_sitter import Node
+from parsing import ClassChunk, FunctionChunk, _parser, _text
+from prompt import count_tokens
+from sourcestore import SourceStore
+
+# definitions longer than this are split, a batch of split records always fits the fast model
+MAX_CHUNK_TOKENS = 4*1000
+
+def _definition_node(chunk: Union[FunctionChunk, ClassChunk], source: bytes) -> Node:
+    # oversized definitions are rare, so their file is parsed again rather than keeping every tree
+    tree = _parser.parse(source)
+    node = tree.root_node.descendant_for_byte_range(chunk.span.start_byte, chunk.span.end_byte)
+    while node.type not in ("function_definition", "class_definition", "decorated_definition"):
+        node = node.parent
+    if node.type == "decorated_definition":
+        node = node.child_by_field_name("definition")
+    return node
+
+def _line(node: Node) -> int:
+    return node.start_point[0] + 1
+
+def _render(source: bytes, start: int, end: int, collapsed: list) -> str:
+    # source between the bytes with the bodies of the collapsed definitions inside replaced by `...`
+    parts = []
+    pos = start
+    for child in collapsed:
+        if start <= child.span.start_byte and child.span.end_byte <= end:
+            parts.append(_text(source, pos, child.body_start))
+            parts.append("...")
+            pos = child.span.end_byte
+    parts.append(_text(source, pos, end))
+    return "".join(parts)
+
+def _lines(source: bytes, start: int, end: int, start_line: int, collapsed: list) -> list[tuple[str, int, int]]:
+    # (text, first line, last line) of every line between the bytes, rendered like _render.
+    # The line where the body of a collapsed definition starts runs on to the end of its last line.
+    inside = [child for child in collapsed if start <= child.span.start_byte and child.span.end_byte <= end]
+    r = []
+    pos = start
+    line = start_line
+    i = 0
+    while pos < end:
+        newline = source.find(b"\n", pos, end)
+        stop = end if newline == -1 else newline + 1
+        last = line
+        parts = []
+        while i < len(inside) and inside[i].body_start < stop:
+            parts.append(_text(source, pos, inside[i].body_start))
+            parts.append("...")
+            pos = inside[i].span.end_byte
+            last = inside[i].span.end_line
+            newline = source.find(b"\n", pos, end)
+            stop = end if newline == -1 else newline + 1
+            i += 1
+        parts.append(_text(source, pos, stop))
+        r.append(("".join(parts), line, last))
+        pos = stop
+        line = last + 1
+    return r
+
+def _collapsed(chunk: Union[FunctionChunk, ClassChunk]) -> list:
+    if not isinstance(chunk, ClassChunk):
+        return []
+    return sorted(chunk.methods + chunk.inner_classes, key=lambda c: c.span.start_byte)
+
+def class_skeleton(chunk: ClassChunk, store: SourceStore) -> str:
+    """
+    The class with the bodies of its methods and inner classes replaced by `...`,
+    what is left is the header, the docstring, class attributes and the signatures.
+    """
+    return _render(store.source(chunk.span.file), chunk.span.start_byte, chunk.span.end_byte, _collapsed(chunk))
+
+def definition_blocks(
+        chunk: Union[FunctionChunk, ClassChunk],
+        store: SourceStore,
+        max_tokens: int = MAX_CHUNK_TOKENS
+) -> list[tuple[str, int, int]]:
+    """
+    A long function or class cut into (text, start line, end line) blocks of consecutive
+    top-level statements, each block at most `max_tokens` where possible. The first block
+    carries the signature. Methods and inner classes of a class appear as in its skeleton.
+    A single statement that is still too long is cut at line boundaries.
+    """
+    source = store.source(chunk.span.file)
+    collapsed = _collapsed(chunk)
+    def render(start: int, end: int) -> str:
+        return _render(source, start, end, collapsed)
+
+    node = _definition_node(chunk, source)
+    statements = node.child_by_field_name("body").named_children
+    blocks = []
+    start = chunk.span.start_byte
+    start_line = chunk.span.start_line
+    tokens = 0
+    end = start
+    end_line = start_line
+    for statement in statements:
+        cnt = count_tokens(render(end, statement.end_byte))
+        if tokens + cnt > max_tokens and end > start:
+            blocks.append((start, end, start_line, end_line))
+            start = source.rfind(b"\n", 0, statement.start_byte) + 1
+            start_line = _line(statement)
+            tokens = count_tokens(render(start, statement.end_byte))
+        else:
+            tokens += cnt
+        end = statement.end_byte
+        end_line = statement.end_point[0] + 1
+    blocks.append((start, end, start_line, end_line))
+
+    r = []
+    for start, end, start_line, end_line in blocks:
+        text = render(start, end)
+        if count_tokens(text) <= max_tokens:
+            r.append((text, start_line, end_line))
+            continue
+        # a statement that is still too long, its line numbers come from the source, not from
+        # the rendered text, which has fewer lines when collapsed definitions are inside it
+        sub = []
+        tokens = 0
+        for line in _lines(source, start, end, start_line, collapsed):
+            cnt = count_tokens(line[0])
+            if tokens + cnt > max_tokens and len(sub) > 0:
+                r.append(("".join(map(lambda l: l[0], sub)), sub[0][1], sub[-1][2]))
+                sub = []
+                tokens = 0
+            sub.append(line)
+            tokens += cnt
+        if len(sub) > 0:
+            r.append(("".join(map(lambda l: l[0], sub)), sub[0][1], sub[-1][2]))
+    return r
@@ -0,0 +1,238 @@
+import fcntl
+import os
+import re
+import shutil
+from contextlib import contextmanager
+from enum import Enum
+from hashlib import sha1
+from pathlib import Path
+from typing import Iterator, List, Optional, Type, TypeVar
+from git import Git, Repo
+
+DEFAULT_MAX_BYTES = 20 * (1 << 30)
+
+class CheckoutLink(Enum):
+    WORKTREE = "worktree"   # git worktree of the mirror, objects are shared
+    HARDLINK = "hardlink"   # local clone of the mirror, objects are hardlinked (copied across file systems)
+
+def _dir_size(path: Path, seen: set) -> int:
+    """Disk usage of `path`, files hardlinked to an inode already in `seen` are not counted again."""
+    total = 0
+    stack = [str(path)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if st.st_nlink > 1:
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+    return total
+
+T = TypeVar('T', bound='CloneCache')
+class CloneCache:
+    """
+    Host-level cache of bare mirrors shared by analyzer workers, one mirror per repository URL.
+    A mirror is cloned once and fetched afterwards, every worker gets a cheap checkout of it.
+
+    Each mirror has two lock files. Writers (clone, fetch, worktree registration) serialise on
+    `<key>.lock`, and workers reading from a mirror hold `<key>.lease` shared for as long as they
+    use it, taken before the writer lock is released. A checkout is held by its worker through
+    `<name>.checkout` until `remove_checkout` or process exit. Eviction first removes checkouts
+    nobody holds, then least recently used mirrors until mirrors and checkouts together fit in
+    `max_bytes`, skipping mirrors that are being written or are leased by anyone. Checkouts live
+    under the cache root so that every container sees the same paths, which keeps worktree
+    bookkeeping valid and lets hardlinks work.
+    """
+    @classmethod
+    def from_env(cls: Type[T]) -> Optional[T]:
+        root = os.getenv("CLONE_CACHE_DIR")
+        if not root:
+            return None
+        return cls(root, int(os.getenv("CLONE_CACHE_MAX_BYTES") or DEFAULT_MAX_BYTES))
+
+    def __init__(self, root: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = Path(os.path.abspath(root))
+        self.max_bytes = max_bytes
+        self._leases = {}
+        self._checkouts = {}
+        (self.root / "mirrors").mkdir(parents=True, exist_ok=True)
+        (self.root / "locks").mkdir(parents=True, exist_ok=True)
+        (self.root / "checkouts").mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(url: str) -> str:
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", url.rstrip("/").split("/")[-1].removesuffix(".git"))
+        return f"{sha1(url.encode()).hexdigest()[:16]}-{name}"
+
+    def mirror_path(self, url: str) -> Path:
+        return self.root / "mirrors" / f"{CloneCache.key(url)}.git"
+
+    def checkout_path(self, name: str) -> Path:
+        return self.root / "checkouts" / name
+
+    def mirror(self, url: str, lease: bool = False) -> Path:
+        """Clone or fetch the mirror of `url` and return its path, leased before it can be evicted if `lease`."""
+        key = CloneCache.key(url)
+        with self._lock(key):
+            path = self._refresh(url)
+            if lease:
+                self._lease(key)
+        self.evict(keep=key)
+        return path
+
+    def _lease(self, key: str):
+        # shared lock on the mirror until `release` or process exit, so it is not evicted under us
+        if key in self._leases:
+            return
+        f = open(self._lease_path(key), "a")
+        fcntl.flock(f, fcntl.LOCK_SH)
+        self._leases[key] = f
+
+    def release(self, url: str):
+        f = self._leases.pop(CloneCache.key(url), None)
+        if f is not None:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def checkout(
+            self,
+            url: str,
+            dest: Path,
+            sparse_patterns: Optional[List[str]] = None,
+            link: CheckoutLink = CheckoutLink.WORKTREE
+    ) -> Repo:
+        """
+        Working tree of the mirror's HEAD at `dest`, restricted to `sparse_patterns` if given.
+        Sparse checkouts always use a hardlinked clone: sparse-checkout in a worktree would turn on
+        extensions.worktreeConfig in the shared mirror config.
+        """
+        dest = Path(os.path.abspath(dest))
+        if sparse_patterns:
+            link = CheckoutLink.HARDLINK
+        key = CloneCache.key(url)
+        with self._lock(key):
+            self._hold_checkout(dest)
+            # left behind by an earlier worker of the same analyzer
+            shutil.rmtree(dest, ignore_errors=True)
+            path = self._refresh(url)
+            if link == CheckoutLink.WORKTREE:
+                Git(str(path)).worktree("add", "--detach", "--no-checkout", str(dest), "HEAD")
+                cloned = Repo(dest)
+            else:
+                cloned = Repo.clone_from(str(path), dest, local=True, no_checkout=True)
+            self._lease(key)
+        if sparse_patterns:
+            cloned.git.sparse_checkout("set", "--no-cone", *sparse_patterns)
+        cloned.git.reset("--hard", "HEAD")
+        self.evict(keep=key)
+        return cloned
+
+    def remove_checkout(self, dest: Path):
+        """Delete a checkout made by this process and let go of it."""
+        dest = Path(os.path.abspath(dest))
+        f = self._checkouts.pop(dest.name, None)
+        if f is None:
+            return
+        shutil.rmtree(dest, ignore_errors=True)
+        self._checkout_lock_path(dest.name).unlink(missing_ok=True)
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+    def evict(self, keep: Optional[str] = None):
+        """
+        Remove checkouts of exited workers, then least recently used mirrors until the cache fits,
+        skipping mirrors in use and `keep`.
+        """
+        with self._lock("cache", blocking=True):
+            seen = set()
+            total = 0
+            for path in (self.root / "checkouts").iterdir():
+                if path.name in self._checkouts:
+                    total += _dir_size(path, seen)
+                    continue
+                try:
+                    with self._lock(path.name, blocking=False, checkout=True):
+                        shutil.rmtree(path, ignore_errors=True)
+                        self._checkout_lock_path(path.name).unlink(missing_ok=True)
+                        print(f"removed checkout {path.name} from clone cache")
+                except BlockingIOError:
+                    total += _dir_size(path, seen)
+            mirrors = []
+            for path in (self.root / "mirrors").iterdir():
+                if path.suffix == ".git":
+                    mirrors.append((self._last_used(path.stem), path.stem, path, _dir_size(path, seen)))
+            total += sum(m[3] for m in mirrors)
+            mirrors.sort()
+            for _, key, path, size in mirrors:
+                if total <= self.max_bytes:
+                    break
+                if key == keep or key in self._leases:
+                    continue
+                try:
+                    with self._lock(key, blocking=False), self._lock(key, blocking=False, lease=True):
+                        shutil.rmtree(path)
+                        self._stamp_path(key).unlink(missing_ok=True)
+                        total -= size
+                        print(f"evicted {key} from clone cache ({size} bytes)")
+                except BlockingIOError:
+                    continue
+
+    def _refresh(self, url: str) -> Path:
+        # caller holds the exclusive lock of the mirror
+        key = CloneCache.key(url)
+        path = self.mirror_path(url)
+        if (path / "HEAD").exists():
+            mirror = Git(str(path))
+            mirror.fetch("--prune", "origin")
+            mirror.worktree("prune")
+        else:
+            tmp = path.with_suffix(".tmp")
+            shutil.rmtree(tmp, ignore_errors=True)
+            Repo.clone_from(url, tmp, mirror=True)
+            os.replace(tmp, path)
+        self._stamp_path(key).touch()
+        return path
+
+    def _last_used(self, key: str) -> float:
+        try:
+            return self._stamp_path(key).stat().st_mtime
+        except FileNotFoundError:
+            return 0.0
+
+    def _lock_path(self, key: str) -> Path:
+        return self.root / "locks" / f"{key}.lock"
+
+    def _lease_path(self, key: str) -> Path:
+        return self.root / "locks" / f"{key}.lease"
+
+    def _checkout_lock_path(self, name: str) -> Path:
+        return self.root / "locks" / f"{name}.checkout"
+
+    def _hold_checkout(self, dest: Path):
+        # exclusive lock on the checkout until `remove_checkout` or process exit, so it is not removed under us
+        if dest.name in self._checkouts:
+            return
+        f = open(self._checkout_lock_path(dest.name), "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        self._checkouts[dest.name] = f
+
+    def _stamp_path(self, key: str) -> Path:
+        return self.root / "locks" / f"{key}.used"
+
+    @contextmanager
+    def _lock(self, key: str, blocking: bool = True, lease: bool = False, checkout: bool = False) -> Iterator[None]:
+        if checkout:
+            path = self._checkout_lock_path(key)
+        else:
+            path = self._lease_path(key) if lease else self._lock_path(key)
+        with open(path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
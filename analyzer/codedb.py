@@ -1,34 +1,150 @@
-from concurrent.futures import ThreadPoolExecutor
+import re
 import threading
 import numpy as np
-from dataclasses import dataclass, asdict
-from typing import Union
-from redis.commands.search.field import VectorField
+import os
+from dataclasses import dataclass, replace
+from typing import Optional, Union
+from redis.commands.search.field import TagField, TextField
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 from redis.commands.search import Search
 from redis.commands.search.query import Query
 
-from sentence_transformers import SentenceTransformer
-from repo import Repository
-from parsing import parse, CodeChunk, ClassChunk, FunctionChunk
+from embedder import get_embedder
+from repo import Repository, PARSABLE_EXTENSIONS
+from ignore import is_generated_source
+from parsing import parse, parse_incremental, touched, body_hash, CodeChunk, ClassChunk, FunctionChunk, Hunk, TreeCache
+from chunking import MAX_CHUNK_TOKENS, class_skeleton, definition_blocks
+from parsecache import ParseCache
+from sourcestore import SourceStore, Span
 from common.redis import get_redis
 from llm import LLM
-from prompt import get_summarization_prompt, count_tokens, sep_token
+from prompt import get_summarization_prompt, count_tokens, sep_token, SUMMARIZATION_PROMPT_VERSION
+from budget import TokenBudget, score, cheap_description
+from importgraph import ImportGraph
+from pipeline import Pipeline, Stage
+from desccache import DescriptionCache
+from vectorindex import VectorIndexConfig, pack
+
+# tokens of dependency summaries prepended to a summarization batch
+DEPENDENCY_CONTEXT_TOKENS = 1000
+
+# embedding batches of descriptions collected before they are sorted by length and encoded
+EMBED_WINDOW_BATCHES = 4
+
+# rank offset of reciprocal rank fusion, keeps a single first place from outweighing agreement
+RRF_K = 60
+RETURN_FIELDS = ("type", "path", "name", "body", "description", "parent")
+
+def _text_fields() -> tuple:
+    # full text fields next to the vector, so identifiers named in a query are found by BM25
+    return (
+        TextField("name", weight=2.0),
+        TextField("description"),
+        TagField("path"),
+        TagField("type"),
+    )
+
+def _text_query(text: str) -> Optional[str]:
+    """Any word of `text` in a name or description, words are matched by the index tokenizer."""
+    terms = sorted(set(term.lower() for term in re.findall(r"\w+", text) if len(term) > 1))
+    if len(terms) == 0:
+        return None
+    return f"@name|description:({'|'.join(terms)})"
+
+SUMMARY_MODEL = "qwen25-coder-32b-instruct"
+LARGE_SUMMARY_MODEL = "llama3.3-70b-instruct-fp8"
 
 def _get_llm(system: str, user: str):
     len = count_tokens(system) + count_tokens(user)
     if len > 32*1000:
-        return LLM(model="llama3.3-70b-instruct-fp8")
+        return LLM(model=LARGE_SUMMARY_MODEL)
     else:
-        return LLM(model="qwen25-coder-32b-instruct")
+        return LLM(model=SUMMARY_MODEL)
 
-@dataclass
 class CodeRecord:
-    type: str
-    path: str
-    name: str
-    body: str
-    description: str
+    """
+    A definition to describe and index. Records of a build point into the source store and
+    decode their body only when a prompt or Redis needs it, records read back from Redis
+    carry their body.
+    """
+    __slots__ = (
+        "type", "path", "name", "description", "hash", "parent",
+        "start_line", "end_line", "_body", "_span", "_store"
+    )
+
+    @classmethod
+    def from_span(cls, type: str, path: str, name: str, span: Span, store: SourceStore, parent: str = ""):
+        rec = cls(type, path, name, None, "", store.hash(span), parent, span.start_line, span.end_line)
+        rec._span = span
+        rec._store = store
+        return rec
+
+    def __init__(
+            self,
+            type: str,
+            path: str,
+            name: str,
+            body: Optional[str],
+            description: str,
+            hash: str = "",
+            parent: str = "",   # definition the record belongs to, a class for methods
+            start_line: int = 0,
+            end_line: int = 0
+    ):
+        self.type = type
+        self.path = path
+        self.name = name
+        self.description = description
+        self.hash = hash if hash or body is None else body_hash(body)
+        self.parent = parent
+        self.start_line = start_line
+        self.end_line = end_line
+        self._body = body
+        self._span = None
+        self._store = None
+
+    @property
+    def body(self) -> str:
+        return self._body if self._body is not None else self._store.text(self._span)
+
+    def to_dict(self) -> dict:
+        return {
+            "type": self.type,
+            "path": self.path,
+            "name": self.name,
+            "body": self.body,
+            "description": self.description,
+            "hash": self.hash,
+            "parent": self.parent,
+            "start_line": self.start_line,
+            "end_line": self.end_line,
+        }
+
+def _summary_line(name: str, description: str) -> str:
+    # first sentence of the description is enough context for the files importing it
+    return f"{name}: {description.strip().split('. ')[0].rstrip('.')}."
+
+def _shift_line(line: int, hunks: list[Hunk]) -> int:
+    """Line number after the diff of a line that is not part of any hunk, 0 for lines inside one."""
+    delta = 0
+    for old_start, old_count, new_start, new_count in hunks:
+        if line < old_start or (old_count == 0 and line == old_start):
+            break
+        if line < old_start + old_count:
+            return 0
+        delta += new_count - old_count
+    return line + delta if line > 0 else 0
+
+def _str(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+def _parse_search(res: list) -> list[tuple[str, dict[str, str]]]:
+    """(key, fields) of a raw FT.SEARCH reply, as a search pipeline returns it."""
+    r = []
+    for i in range(1, len(res), 2):
+        fields = res[i + 1]
+        r.append((_str(res[i]), {_str(fields[j]): _str(fields[j + 1]) for j in range(0, len(fields), 2)}))
+    return r
 
 @dataclass
 class QueryResult:
@@ -38,11 +154,20 @@ class QueryResult:
 class CodeDB:
     def __init__(
             self,
-            repo: Repository
+            repo: Repository,
+            token_budget: Optional[int] = None,
+            parse_cache: Optional[ParseCache] = None,
+            desc_cache: Optional[DescriptionCache] = None,
+            vector_index: Optional[VectorIndexConfig] = None
     ):
         self.redis = get_redis()
         self.repo = repo
-        self.embedder = SentenceTransformer("sentence-transformer")
+        self.token_budget = token_budget
+        self.parse_cache = parse_cache
+        self.desc_cache = desc_cache
+        self.vector_index = vector_index if vector_index is not None else VectorIndexConfig()
+        self.trees = TreeCache(load=repo.read_blob)
+        self.embedder = get_embedder()
         self.index = None
     
     def exists(self) -> bool:
@@ -52,37 +177,97 @@ class CodeDB:
         except:
             return False
     
-    def build(self, threads: int = 16):
-        self.index = self._build(threads)
+    def build(self, threads: int = 16, processes: int = os.cpu_count() or 1):
+        self.index = self._build(threads, processes)
+
+    def update(self, threads: int = 16):
+        """
+        Bring an existing index forward to the repository HEAD.
+        Only files changed since the indexed commit are parsed again, incrementally from the
+        tree of their previous version, and only definitions touched by the diff are extracted. Records whose content did not change are kept as they are.
+        """
+        self.index = self._update(threads)
+
+    def drop(self):
+        try:
+            self.redis.ft(self._redis_index_name).dropindex(delete_documents=True)
+        except:
+            pass
+        for key in self.redis.scan_iter(f"{self._redis_prefix}*"):
+            self.redis.delete(key)
+        self.index = None
+
+    @property
+    def import_graph(self) -> Optional[ImportGraph]:
+        return ImportGraph.from_redis(self.redis, self._imports_key)
+
+    @property
+    def commit(self) -> Optional[str]:
+        return self.redis.get(name=self._commit_key)
+
+    @property
+    def vector_type(self) -> str:
+        """Element type of the stored vectors, fixed when the index is built."""
+        return self.redis.get(name=self._vector_type_key) or self.vector_index.vector_type
     
     def search(self, query: str, n: int = 1) -> list[QueryResult]:
-        encoded_query = self._encode([query.strip()])[0]
-        query = (
+        return self.search_many([query], n)
+
+    def search_many(self, queries: list[str], n: int = 1, hybrid: bool = False) -> list[QueryResult]:
+        """
+        The `n` nearest records of every query, best first. All queries are encoded in one batch
+        and searched in one pipelined round trip, a record found by several queries is returned
+        once with its best score, the cosine distance.
+        With `hybrid` every query also runs as a BM25 full text query over names and descriptions
+        in the same round trip, and all ranked lists are merged by reciprocal rank fusion.
+        Scores are fusion scores then, higher is better.
+        """
+        queries = [query.strip() for query in queries if query.strip()]
+        if len(queries) == 0:
+            return []
+        vectors = pack(self._encode(queries), self.vector_type)
+        knn = (
             Query(f"(*)=>[KNN {n} @embedding $query_vector AS score]")
                 .sort_by("score")
-                .return_fields("score", "$.type", "$.path", "$.name", "$.body", "$.description")
+                .return_fields("score", *RETURN_FIELDS)
                 .dialect(2)
         )
-        docs = self.index.search(
-            query,
-            {
-                'query_vector': np.array(encoded_query, dtype=np.float32).tobytes()
-            }
-        ).docs
-        
-        def doc2qresult(doc) -> QueryResult:
+        pipeline = self.redis.ft(self._redis_index_name).pipeline(transaction=False)
+        for vector, text in zip(vectors, queries):
+            pipeline.search(knn, {'query_vector': vector})
+            text = _text_query(text) if hybrid else None
+            if text is not None:
+                pipeline.search(Query(text).scorer("BM25").return_fields(*RETURN_FIELDS).paging(0, n).dialect(2))
+
+        def to_result(doc: dict[str, str]) -> QueryResult:
             return QueryResult(
-                score=doc.score,
+                score=float(doc.get("score", 0.0)),
                 rec=CodeRecord(
-                    type=doc["$.type"],
-                    path=doc["$.path"],
-                    name=doc["$.name"],
-                    body=doc["$.body"],
-                    description=doc["$.description"]
+                    type=doc["type"],
+                    path=doc["path"],
+                    name=doc["name"],
+                    body=doc["body"],
+                    description=doc["description"],
+                    parent=doc.get("parent", "")
                 )
             )
 
-        return list(map(doc2qresult, docs))
+        best = {}
+        if not hybrid:
+            for res in pipeline.execute():
+                for id, doc in _parse_search(res):
+                    result = to_result(doc)
+                    if id not in best or result.score < best[id].score:
+                        best[id] = result
+            return sorted(best.values(), key=lambda r: r.score)
+
+        for res in pipeline.execute():
+            for rank, (id, doc) in enumerate(_parse_search(res)):
+                if id not in best:
+                    best[id] = to_result(doc)
+                    best[id].score = 0.0
+                best[id].score += 1 / (RRF_K + rank + 1)
+        return sorted(best.values(), key=lambda r: r.score, reverse=True)
     
     @property
     def readme(self) -> str:
@@ -92,129 +277,535 @@ class CodeDB:
     def directories(self) -> list[str]:
         return self.redis.lrange(name=self._directories_key, start=0, end=-1)
     
-    def _encode(self, s: list[str]) -> list[list[np.float32]]:
-        return self.embedder.encode(
-            s,
-            precision='float32'
-        ).astype(np.float32).tolist()
+    def _encode(self, s: list[str]) -> np.ndarray:
+        return self.embedder.encode(s)
     
-    def _build(self, threads: int) -> Search:
+    def _build(self, threads: int, processes: int = 1) -> Search:
         if self.exists():
-            index = self.redis.ft(self._redis_index_name)
             print("use existing index")
+            return self._migrate()
+        
+        self._save_repo_info()
+        self.redis.set(name=self._vector_type_key, value=self.vector_index.vector_type)
+        
+        print("parsing repository")
+        codes = parse(self.repo, processes=processes, cache=self.parse_cache)
+        print(self.repo.ignore.summary())
+        recs = self._extract_records(codes)
+        graph = ImportGraph.from_codes(codes)
+        graph.save(self.redis, self._imports_key)
+
+        self._generate(recs, range(len(recs)), threads, graph)
+        n_recs = len(recs)
+        self.redis.set(name=self._next_id_key, value=n_recs)
+        self.redis.set(name=self._commit_key, value=self.repo.head_sha)
+        del recs[:]
+        del recs
+        
+        index = self._create_index(n_recs, self.embedder.dimension)
+        self.redis.bgsave()
+        print("done")
+        return index
+
+    def _create_index(self, records: int, dim: int) -> Search:
+        vector_type = self.vector_type
+        print(f"build {self.vector_index.algorithm_for(records)} {vector_type} index of {records} records for searching")
+        schema = (
+            self.vector_index.field("embedding", dim, records, vector_type),
+            *_text_fields(),
+        )
+        definition = IndexDefinition(prefix=[self._codechunk_prefix], index_type=IndexType.HASH)
+        index = self.redis.ft(self._redis_index_name)
+        index.create_index(fields=schema, definition=definition)
+        return index
+
+    def _migrate(self) -> Search:
+        """
+        Move an index of JSON documents, the layout before vectors were stored as blobs, to
+        hashes. Records are rewritten in place under their keys, then the index is created again.
+        A hash index without the full text fields gets them added, Redis indexes the existing
+        records in the background.
+        """
+        index = self.redis.ft(self._redis_index_name)
+        info = index.info()
+        definition = info["index_definition"]
+        if definition[definition.index("key_type") + 1] != "JSON":
+            attributes = set(map(lambda a: a[a.index("attribute") + 1], info["attributes"]))
+            missing = [field for field in _text_fields() if field.name not in attributes]
+            if len(missing) > 0:
+                print(f"adding {', '.join(map(lambda f: f.name, missing))} to the index")
+                index.alter_schema_add(missing)
             return index
+
+        vector_type = self.vector_index.vector_type
+        print(f"migrating index to hash records with {vector_type} vectors")
+        index.dropindex(delete_documents=False)
+        self.redis.set(name=self._vector_type_key, value=vector_type)
+        keys = list(self.redis.scan_iter(f"{self._codechunk_prefix}*"))
+        dim = None
+        for i in range(0, len(keys), 256):
+            batch = keys[i:i + 256]
+            pipeline = self.redis.pipeline()
+            for key in batch:
+                pipeline.json().get(key)
+            docs = pipeline.execute()
+            pipeline = self.redis.pipeline()
+            for key, doc in zip(batch, docs):
+                if doc is None or "embedding" not in doc:
+                    continue
+                embedding = np.array(doc.pop("embedding"), dtype=np.float32)
+                dim = len(embedding)
+                doc = {k: v for k, v in doc.items() if v is not None}
+                doc["embedding"] = pack(embedding[np.newaxis], vector_type)[0]
+                pipeline.delete(key)
+                pipeline.hset(key, mapping=doc)
+            pipeline.execute()
+            print(f"{min(i + 256, len(keys))}/{len(keys)} records migrated")
+        index = self._create_index(len(keys), dim or self.embedder.dimension)
+        self.redis.bgsave()
+        return index
+
+    def _update(self, threads: int) -> Search:
+        old_commit = self.commit
+        new_commit = self.repo.head_sha
+        if old_commit is None:
+            print("index has no commit, rebuilding")
+            self.drop()
+            return self._build(threads)
+        if old_commit == new_commit:
+            print("index is up to date")
+            return self.redis.ft(self._redis_index_name)
         
+        self._save_repo_info()
+
+        print(f"diff {old_commit[:8]}..{new_commit[:8]}")
+        changed = [
+            path for _, path in self.repo.changed_files(old_commit, new_commit)
+            if os.path.splitext(path)[1] in PARSABLE_EXTENSIONS
+        ]
+
+        print(f"collect previous records of {len(changed)} files")
+        previous = {}
+        fields = ("type", "name", "hash", "start_line", "end_line")
+        for path in changed:
+            keys = list(self.redis.smembers(self._file_key(path)))
+            pipeline = self.redis.pipeline()
+            for key in keys:
+                pipeline.hmget(key, fields)
+            previous[path] = []
+            for key, values in zip(keys, pipeline.execute()):
+                old = {k: v for k, v in zip(fields, values) if v is not None}
+                for k in ("start_line", "end_line"):
+                    if k in old:
+                        old[k] = int(old[k])
+                previous[path].append((key, old))
+
+        print("parsing changed files")
+        hunks = self.repo.diff_hunks(old_commit, new_commit, changed)
+        codes = []
+        dirty_codes = []
+        clean_lines = {}
+        # the same files as a build: ignored ones are not in the index, generated ones are skipped,
+        # and the previous records of either are left unmatched and removed below
+        skipped = set()
+        for path in changed:
+            file = self.repo.index.get(path)
+            if file is None or not file.is_file:
+                skipped.add(path)
+                continue
+            source = file.read("rb")
+            if is_generated_source(source):
+                self.repo.ignore.record("generated", size=len(source))
+                skipped.add(path)
+                continue
+            old_sha, file_hunks = hunks.get(path, (None, []))
+            code, changed_bytes = parse_incremental(source, file.relpath, file.name, old_sha, file_hunks, self.trees)
+            codes.append(code)
+            if changed_bytes is None:
+                dirty_codes.append(code)
+                continue
+            # only definitions touching a changed range are extracted again
+            def dirty(chunk) -> bool:
+                return touched(chunk, changed_bytes)
+            dirty_codes.append(replace(
+                code,
+                classes=list(filter(dirty, code.classes)),
+                functions=list(filter(dirty, code.functions))
+            ))
+            clean_lines[path] = (file_hunks, [
+                (chunk.span.start_line, chunk.span.end_line)
+                for chunk in code.classes + code.functions if not dirty(chunk)
+            ])
+        recs = self._extract_records(dirty_codes)
+
+        graph = self.import_graph
+        if graph is None or len(graph.modules) < len(graph):
+            print("index has no import graph with import statements, parsing repository for it")
+            graph = ImportGraph.from_codes(parse(self.repo, cache=self.parse_cache))
+        else:
+            graph.update(codes, removed=skipped)
+        graph.save(self.redis, self._imports_key)
+
+        # previous records inside an untouched definition are kept, with their lines moved.
+        # The others are matched to the new records by content, what is left over is stale.
+        kept = []
+        by_hash = {}
+        for path, olds in previous.items():
+            file_hunks, clean = clean_lines.get(path, ([], []))
+            for key, old in olds:
+                start = _shift_line(old.get("start_line", 0), file_hunks)
+                end = _shift_line(old.get("end_line", 0), file_hunks)
+                if start and end and any(s <= start and end <= e for s, e in clean):
+                    kept.append((key, old, start, end))
+                else:
+                    by_hash.setdefault((path, old.get("type"), old.get("name"), old.get("hash")), []).append((key, old))
+        fresh = []
+        for rec in recs:
+            matches = by_hash.get((rec.path, rec.type, rec.name, rec.hash))
+            if matches:
+                key, old = matches.pop()
+                kept.append((key, old, rec.start_line, rec.end_line))
+            else:
+                fresh.append(rec)
+        stale_keys = {}
+        for (path, _, _, _), matches in by_hash.items():
+            stale_keys.setdefault(path, []).extend(map(lambda m: m[0], matches))
+        n_stale = sum(map(len, stale_keys.values()))
+        print(f"{len(kept)} records unchanged, {len(fresh)} records to describe, {n_stale} records removed")
+
+        pipeline = self.redis.pipeline()
+        for key, old, start, end in kept:
+            if old.get("start_line") != start or old.get("end_line") != end:
+                pipeline.hset(key, mapping={"start_line": start, "end_line": end})
+        pipeline.execute()
+
+        # new records are pushed under fresh ids before the stale ones go away,
+        # so a failed update leaves the previous records searchable
+        if len(fresh) > 0:
+            first = self.redis.incrby(self._next_id_key, len(fresh)) - len(fresh)
+            dependencies = set().union(*map(lambda code: graph.imports.get(code.path, set()), codes))
+            summaries = self._load_summaries(dependencies - set(changed))
+            self._generate(fresh, range(first, first + len(fresh)), threads, graph, summaries)
+        if n_stale > 0:
+            pipeline = self.redis.pipeline()
+            for path, keys in stale_keys.items():
+                if len(keys) > 0:
+                    pipeline.srem(self._file_key(path), *keys)
+                    pipeline.delete(*keys)
+            pipeline.execute()
+        self.redis.set(name=self._commit_key, value=new_commit)
+        self.redis.bgsave()
+        print("done")
+        return self.redis.ft(self._redis_index_name)
+
+    def _save_repo_info(self):
         print("saving readme")
         readme = self.repo.readme.read() if self.repo.readme is not None else ""
         self.redis.set(name=self._readme_key, value=readme)
 
         print("saving directories")
-        directories = map(
+        directories = list(map(
             lambda x: x.relpath,
             self.repo.directories
+        ))
+        self.redis.delete(self._directories_key)
+        if len(directories) > 0:
+            self.redis.rpush(self._directories_key, *directories)
+
+    def _generate(
+            self,
+            recs: list[CodeRecord],
+            ids: range,
+            threads: int,
+            graph: Optional[ImportGraph] = None,
+            summaries: Optional[dict[str, list[str]]] = None
+    ):
+        """
+        Describe, embed and push the records under `ids`. Records sharing a body hash are
+        described and embedded once and the result is pushed for every occurrence.
+        Bodies found in the description cache are not described again. The other unique records
+        are ranked and described by the LLM in that order until the token budget runs out,
+        the rest get a description built from their signature and docstring.
+        LLM batches follow the import graph, files before the files importing them, and every
+        batch gets the summaries of the files it imports that are described by then.
+        Batching, LLM calls, embedding and Redis writes run as overlapping pipeline stages.
+        """
+        unique = {}
+        for rec, id in zip(recs, ids):
+            unique.setdefault(rec.hash, []).append((rec, id))
+        fan_in = graph.fan_in() if graph is not None else {}
+        unique_recs = sorted(
+            map(lambda occurrences: occurrences[0][0], unique.values()),
+            key=lambda rec: score(rec.path, rec.name, fan_in.get(rec.path, 0)),
+            reverse=True
         )
-        self.redis.rpush(self._directories_key, *directories)
+        cached = {}
+        if self.desc_cache is not None:
+            cached = self.desc_cache.get_many(unique.keys(), [SUMMARY_MODEL, LARGE_SUMMARY_MODEL], SUMMARIZATION_PROMPT_VERSION)
+        summaries = dict(summaries or {})
+        for rec in unique_recs:
+            if rec.hash in cached and rec.parent == "":
+                summaries.setdefault(rec.path, []).append(_summary_line(rec.name, cached[rec.hash]))
         
-        print("parsing repository")
-        recs = self._extract_records(parse(self.repo))
-        splitted_recs = self._split_chunks(recs)
+        budget = TokenBudget(self.token_budget)
+        # token counts by body hash, every body is tokenized once for the budget and the batches
+        tokens = {}
+        cached_recs = []
+        llm_recs = []
+        cheap_recs = []
+        for rec in unique_recs:
+            if rec.hash in cached:
+                cached_recs.append(rec)
+            elif budget.limit is None:
+                llm_recs.append(rec)
+            else:
+                tokens[rec.hash] = count_tokens(rec.body)
+                if budget.consume(tokens[rec.hash]):
+                    llm_recs.append(rec)
+                else:
+                    cheap_recs.append(rec)
+        if graph is not None:
+            rank = {path: i for i, path in enumerate(graph.order())}
+            llm_recs.sort(key=lambda rec: rank.get(rec.path, len(rank)))
+        llm_batches = self._split_chunks(llm_recs, max_tokens=30*1000 - DEPENDENCY_CONTEXT_TOKENS, counts=tokens)
+        if budget.limit is None:
+            # counted while batching, the unlimited budget only reports them
+            for rec in llm_recs:
+                budget.consume(tokens[rec.hash])
 
-        print("generate descriptions")
+        def batches():
+            for i in range(0, len(cached_recs), 64):
+                yield "cached", cached_recs[i:i + 64]
+            for batch in llm_batches:
+                yield "llm", batch
+            for i in range(0, len(cheap_recs), 64):
+                yield "cheap", cheap_recs[i:i + 64]
 
         lock = threading.Lock()
         done = 0
-        total = len(splitted_recs)
-        def generate_descriptions(recs: list[CodeRecord]):
+        def describe(item):
             nonlocal done
-            bodies = list(map(lambda rec: rec.body, recs))
-            system, user = get_summarization_prompt(bodies)
-            llm = _get_llm(system, user)
-            while True:
-                result = llm.prompt(system, user)
-                result = result.split(sep_token)
-                if len(result) == len(bodies):
-                    lock.acquire()
-                    done += 1
-                    print(f'{done}/{total} done')
-                    lock.release()
-                    return result
-        
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            descriptions = executor.map(generate_descriptions, splitted_recs)
+            source, batch = item
+            if source == "cached":
+                return batch, list(map(lambda rec: cached[rec.hash], batch))
+            if source == "cheap":
+                return batch, list(map(lambda rec: cheap_description(rec.type, rec.path, rec.name, rec.body), batch))
+            with lock:
+                context = self._dependency_context(graph, fan_in, summaries, batch)
+            descriptions, model = self._describe(batch, context)
+            if self.desc_cache is not None:
+                self.desc_cache.put_many(
+                    {rec.hash: description for rec, description in zip(batch, descriptions)},
+                    model,
+                    SUMMARIZATION_PROMPT_VERSION
+                )
+            with lock:
+                done += 1
+                print(f'{done}/{len(llm_batches)} done')
+                for rec, description in zip(batch, descriptions):
+                    if rec.parent == "":
+                        summaries.setdefault(rec.path, []).append(_summary_line(rec.name, description))
+            return batch, descriptions
 
-        print("encode descriptions")
-        descriptions = sum(descriptions, [])
-        embeddings = self._encode(descriptions)
-        embedding_dim = len(embeddings[0])
+        # described batches are collected into a window of several embedding batches,
+        # so the embedder has texts of different lengths to sort into its batches
+        window = EMBED_WINDOW_BATCHES * self.embedder.batch_size
+        pending = []
+        pending_texts = 0
+        def embed(item):
+            nonlocal pending_texts
+            pending.append(item)
+            pending_texts += len(item[0])
+            return embed_pending() if pending_texts >= window else None
 
-        print("push records to redis")
-        remains = range(len(recs))
-        while len(remains) > 0:
-            pipeline = self.redis.pipeline()
-            for i in remains:
-                key = self._codechunk_key(i)
-                recs[i].description = descriptions[i]
-                rec = asdict(recs[i])
-                rec["embedding"] = embeddings[i]
-                pipeline.json().set(key, "$", rec)
-            status = pipeline.execute()
-            remains = list(map(lambda x: x[0], filter(lambda x: not x[1], enumerate(status))))
-        del recs[:]
-        del recs
-        del descriptions[:]
-        del descriptions
-        
-        print("build index for searching")
-        schema = (
-            VectorField(
-                "$.embedding",
-                "FLAT",
-                {
-                    "TYPE": "FLOAT32",
-                    "DIM": embedding_dim,
-                    "DISTANCE_METRIC": "COSINE",
-                },
-                as_name="embedding",
-            ),
+        def embed_pending():
+            nonlocal pending_texts
+            if len(pending) == 0:
+                return None
+            batch = [rec for recs, _ in pending for rec in recs]
+            descriptions = [description for _, texts in pending for description in texts]
+            pending.clear()
+            pending_texts = 0
+            return batch, descriptions, self._encode(descriptions)
+
+        def push(item):
+            batch, descriptions, embeddings = item
+            push_recs = []
+            push_embeddings = []
+            push_ids = []
+            for rec, description, embedding in zip(batch, descriptions, embeddings):
+                for occurrence, id in unique[rec.hash]:
+                    occurrence.description = description
+                    push_recs.append(occurrence)
+                    push_embeddings.append(embedding)
+                    push_ids.append(id)
+            self._push(push_recs, push_embeddings, push_ids)
+
+        print("describe, encode and push records")
+        pipeline = Pipeline(
+            [
+                Stage("describe", describe, workers=threads),
+                Stage("embed", embed, flush=embed_pending),
+                Stage("push", push),
+            ],
+            source_name="batch"
         )
-        definition = IndexDefinition(prefix=self._codechunk_prefix, index_type=IndexType.JSON)
-        index = self.redis.ft(self._redis_index_name)
-        index.create_index(fields=schema, definition=definition)
-        self.redis.bgsave()
-        print("done")
-        return index
+        pipeline.run(batches())
+
+        # copies of LLM-bound bodies that were not sent, the dedup saving
+        duplicates = sum(map(lambda rec: len(unique[rec.hash]) - 1, llm_recs))
+        print(
+            f"build summary: {len(recs)} records, {len(unique)} unique bodies, {len(llm_batches)} LLM calls, "
+            f"{duplicates} duplicate records not sent to the LLM"
+        )
+        if self.desc_cache is not None:
+            rate = f" ({100 * len(cached) / len(unique):.1f}% hit rate)" if unique else ""
+            print(f"description cache: {len(cached)} hits, {len(unique) - len(cached)} misses{rate}")
+        print(budget.summary())
+        print(pipeline.summary())
+
+    def _dependency_context(
+            self,
+            graph: Optional[ImportGraph],
+            fan_in: dict[str, int],
+            summaries: dict[str, list[str]],
+            recs: list[CodeRecord]
+    ) -> str:
+        """
+        Summaries of the files imported by the records that are described by now, most imported
+        first, cut at DEPENDENCY_CONTEXT_TOKENS.
+        """
+        if graph is None:
+            return ""
+        paths = set(map(lambda rec: rec.path, recs))
+        dependencies = set().union(*map(lambda path: graph.imports.get(path, set()), paths))
+        lines = []
+        tokens = 0
+        for path in sorted(dependencies, key=lambda p: (-fan_in.get(p, 0), p)):
+            for line in summaries.get(path, []):
+                line = f"{path}: {line}"
+                tokens += count_tokens(line)
+                if tokens > DEPENDENCY_CONTEXT_TOKENS:
+                    return "\n".join(lines)
+                lines.append(line)
+        return "\n".join(lines)
+
+    def _load_summaries(self, paths: set[str]) -> dict[str, list[str]]:
+        """Summary lines of the top-level definitions of indexed files, read back from Redis."""
+        summaries = {}
+        for path in paths:
+            pipeline = self.redis.pipeline()
+            for key in self.redis.smembers(self._file_key(path)):
+                pipeline.hmget(key, ("name", "parent", "description"))
+            for name, parent, description in pipeline.execute():
+                if name is None or description is None:
+                    continue
+                if not parent:
+                    summaries.setdefault(path, []).append(_summary_line(name, description))
+        return summaries
+
+    def _describe(self, recs: list[CodeRecord], context: str = "") -> tuple[list[str], str]:
+        """Descriptions of the records and the model that wrote them."""
+        bodies = list(map(lambda rec: rec.body, recs))
+        system, user = get_summarization_prompt(bodies, context)
+        llm = _get_llm(system, user)
+        while True:
+            result = llm.prompt(system, user)
+            result = result.split(sep_token)
+            if len(result) == len(bodies):
+                return result, llm.model
+
+    def _push(self, recs: list[CodeRecord], embeddings: list[np.ndarray], ids: Union[range, list[int]]):
+        if len(recs) == 0:
+            return
+        vectors = pack(np.stack(embeddings), self.vector_type)
+        pipeline = self.redis.pipeline()
+        for i, rec in enumerate(recs):
+            key = self._codechunk_key(ids[i])
+            fields = rec.to_dict()
+            fields["embedding"] = vectors[i]
+            pipeline.hset(key, mapping=fields)
+            pipeline.sadd(self._file_key(rec.path), key)
+        pipeline.execute()
 
     def _extract_records(self, codes: list[CodeChunk]) -> list[CodeRecord]:
-        def to_record(path: str, chunk: Union[FunctionChunk, ClassChunk]):
-            return CodeRecord(
-                "function" if isinstance(chunk, FunctionChunk) else "class",
-                path,
-                chunk.name,
-                chunk.body,
-                ""
-            )
+        """
+        Records of the definitions, as spans over one source store shared by the build.
+        A class is described from its skeleton, methods and inner classes get records of
+        their own naming the class in `parent`, so no text is sent or stored twice.
+        Functions, and classes whose skeleton is still over MAX_CHUNK_TOKENS, are split into
+        blocks of statements.
+        """
+        store = SourceStore()
+        store.add_codes(codes)
+
+        def fits(span: Span) -> bool:
+            # a token never spans less than a byte, so short spans need no counting
+            return len(span) <= MAX_CHUNK_TOKENS or count_tokens(store.text(span)) <= MAX_CHUNK_TOKENS
+
+        def block_records(path: str, chunk, name: str):
+            # blocks are named by ordinal, not by lines, so a block moved by an edit above it
+            # keeps its name and is matched to its previous record
+            return [
+                CodeRecord("block", path, f"{name}#{i}", text, "", "", name, start, end)
+                for i, (text, start, end) in enumerate(definition_blocks(chunk, store), 1)
+            ]
+
+        def function_records(path: str, chunk: FunctionChunk, type: str, name: str, parent: str):
+            if fits(chunk.span):
+                return [CodeRecord.from_span(type, path, name, chunk.span, store, parent)]
+            return block_records(path, chunk, name)
+
+        def class_records(path: str, chunk: ClassChunk, name: str, parent: str):
+            span = chunk.span
+            if len(chunk.methods) == 0 and len(chunk.inner_classes) == 0:
+                if fits(span):
+                    return [CodeRecord.from_span("class", path, name, span, store, parent)]
+                return block_records(path, chunk, name)
+            skeleton = class_skeleton(chunk, store)
+            if count_tokens(skeleton) <= MAX_CHUNK_TOKENS:
+                recs = [CodeRecord("class", path, name, skeleton, "", "", parent, span.start_line, span.end_line)]
+            else:
+                recs = block_records(path, chunk, name)
+            for method in chunk.methods:
+                recs += function_records(path, method, "method", f"{name}.{method.name}", name)
+            for inner in chunk.inner_classes:
+                recs += class_records(path, inner, f"{name}.{inner.name}", name)
+            return recs
 
         chunks = []
         for code in codes:
             path = code.path
-            chunks.extend(map(lambda chunk: to_record(path, chunk), code.classes))
-            chunks.extend(map(lambda chunk: to_record(path, chunk), code.functions))
+            for chunk in code.classes:
+                chunks += class_records(path, chunk, chunk.name, "")
+            for chunk in code.functions:
+                chunks += function_records(path, chunk, "function", chunk.name, "")
         return chunks
     
-    def _split_chunks(self, chunks: list[CodeRecord], max_tokens=30*1000) -> list[list[CodeRecord]]:
+    def _split_chunks(
+            self,
+            chunks: list[CodeRecord],
+            max_tokens=30*1000,
+            counts: Optional[dict[str, int]] = None
+    ) -> list[list[CodeRecord]]:
+        """Batches of at most `max_tokens`. `counts` are known token counts by body hash, missing ones are added."""
+        counts = counts if counts is not None else {}
         r = []
         sub = []
         tokens = 0
         for chunk in chunks:
-            cnt = count_tokens(chunk.body)
-            if tokens + cnt > max_tokens or len(sub) >= 16:
+            if chunk.hash not in counts:
+                counts[chunk.hash] = count_tokens(chunk.body)
+            cnt = counts[chunk.hash]
+            if (tokens + cnt > max_tokens or len(sub) >= 16) and len(sub) > 0:
                 r.append(sub)
                 sub = [chunk]
                 tokens = cnt
                 continue
             sub.append(chunk)
             tokens += cnt
-        r.append(sub)
+        if len(sub) > 0:
+            r.append(sub)
         return r 
 
     @property
@@ -234,4 +825,18 @@ class CodeDB:
         return f"{self._redis_prefix}codechunk:"
     def _codechunk_key(self, idx: int) -> str:
         return f"{self._codechunk_prefix}{idx}"
+    def _file_key(self, path: str) -> str:
+        return f"{self._redis_prefix}file:{path}"
+    @property
+    def _imports_key(self) -> str:
+        return f"{self._redis_prefix}imports"
+    @property
+    def _commit_key(self) -> str:
+        return f"{self._redis_prefix}commit"
+    @property
+    def _vector_type_key(self) -> str:
+        return f"{self._redis_prefix}vectortype"
+    @property
+    def _next_id_key(self) -> str:
+        return f"{self._redis_prefix}nextid"
 
@@ -0,0 +1,53 @@
+import os
+from hashlib import sha1
+from typing import Iterable, Optional, Type, TypeVar
+from redis import Redis
+from common.redis import get_redis
+
+DEFAULT_TTL = 30*24*60*60
+KEY_PREFIX = "desccache:"
+
+T = TypeVar('T', bound='DescriptionCache')
+class DescriptionCache:
+    """
+    LLM descriptions shared by every repository, keyed by the body hash of a record, the model
+    that described it and the version of the summarization prompt. Entries expire `ttl` seconds
+    after they were last read, so descriptions that stop being hit leave first; a Redis with an
+    LRU `maxmemory-policy` also evicts them under memory pressure.
+    """
+    @classmethod
+    def from_env(cls: Type[T]) -> Optional[T]:
+        ttl = int(os.getenv("DESC_CACHE_TTL") or DEFAULT_TTL)
+        if ttl <= 0:
+            return None
+        return cls(get_redis(), ttl)
+
+    def __init__(self, redis: Redis, ttl: int = DEFAULT_TTL):
+        self.redis = redis
+        self.ttl = ttl
+
+    @staticmethod
+    def key(hash: str, model: str, version: int) -> str:
+        return KEY_PREFIX + sha1(f"{hash}:{model}:{version}".encode()).hexdigest()
+
+    def get_many(self, hashes: Iterable[str], models: list[str], version: int) -> dict[str, str]:
+        """Cached descriptions by body hash, from the first of `models` that has one."""
+        hashes = list(hashes)
+        pipeline = self.redis.pipeline(transaction=False)
+        for hash in hashes:
+            for model in models:
+                pipeline.getex(self.key(hash, model, version), ex=self.ttl)
+        values = pipeline.execute()
+        r = {}
+        for i, hash in enumerate(hashes):
+            found = next(filter(None, values[i*len(models):(i + 1)*len(models)]), None)
+            if found is not None:
+                r[hash] = found
+        return r
+
+    def put_many(self, descriptions: dict[str, str], model: str, version: int):
+        pipeline = self.redis.pipeline(transaction=False)
+        for hash, description in descriptions.items():
+            pipeline.set(self.key(hash, model, version), description, ex=self.ttl)
+        pipeline.execute()
+
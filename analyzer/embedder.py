@@ -0,0 +1,133 @@
+import os
+import threading
+import numpy as np
+from typing import Iterator, Optional, Type, TypeVar
+
+MODEL_PATH = "sentence-transformer"
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_QUANTIZATION = "avx2"
+
+T = TypeVar('T', bound='Embedder')
+class Embedder:
+    """
+    Sentence embeddings computed in batches of texts with similar lengths, longest first,
+    so short descriptions are not padded to the longest one of a mixed batch. Lengths are
+    counted in characters, which orders texts like their token counts without tokenizing
+    them an extra time. Embeddings are float32 arrays and come back in the order of the input.
+    The model, and torch with it, is loaded on first use.
+    """
+    @classmethod
+    def from_env(cls: Type[T], path: str = MODEL_PATH) -> T:
+        return cls(path, int(os.getenv("EMBED_BATCH_SIZE") or DEFAULT_BATCH_SIZE))
+
+    def __init__(self, path: str = MODEL_PATH, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._load()
+        return self._model
+
+    def _load(self):
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(self.path)
+
+    @property
+    def dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def lengths(self, texts: list[str]) -> list[int]:
+        """Token counts as the model sees them, after truncation to its sequence length."""
+        ids = self.model.tokenizer(texts, truncation=True, max_length=self.model.max_seq_length)["input_ids"]
+        return [len(x) for x in ids]
+
+    def _encode_batch(self, texts: list[str]) -> np.ndarray:
+        return self.model.encode(
+            texts,
+            batch_size=len(texts),
+            precision="float32",
+            convert_to_numpy=True,
+            show_progress_bar=False
+        ).astype(np.float32, copy=False)
+
+    def iter_encode(self, texts: list[str]) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """(positions in `texts`, embeddings) per batch."""
+        if len(texts) == 0:
+            return
+        order = np.argsort(-np.array(list(map(len, texts))), kind="stable")
+        for i in range(0, len(order), self.batch_size):
+            positions = order[i:i + self.batch_size]
+            yield positions, self._encode_batch([texts[j] for j in positions])
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        r = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for positions, embeddings in self.iter_encode(texts):
+            r[positions] = embeddings
+        return r
+
+class OnnxEmbedder(Embedder):
+    """
+    The same model exported to ONNX with dynamically quantized int8 weights and run by ONNX Runtime,
+    for workers without a GPU. `quantization` is the sentence-transformers config of the target CPU,
+    `avx2`, `avx512`, `avx512_vnni` or `arm64`. The worker image ships the export, otherwise it is
+    written next to the model on first use.
+    """
+    @classmethod
+    def from_env(cls: Type[T], path: str = MODEL_PATH) -> T:
+        return cls(
+            path,
+            int(os.getenv("EMBED_BATCH_SIZE") or DEFAULT_BATCH_SIZE),
+            os.getenv("EMBEDDING_ONNX_QUANTIZATION") or DEFAULT_QUANTIZATION
+        )
+
+    def __init__(self, path: str = MODEL_PATH, batch_size: int = DEFAULT_BATCH_SIZE, quantization: str = DEFAULT_QUANTIZATION):
+        super().__init__(path, batch_size)
+        self.quantization = quantization
+
+    @property
+    def file_name(self) -> str:
+        return f"onnx/model_qint8_{self.quantization}.onnx"
+
+    def export(self):
+        if os.path.exists(os.path.join(self.path, self.file_name)):
+            return
+        from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+        print(f"exporting {self.path} to {self.file_name}")
+        fp32 = SentenceTransformer(self.path, backend="onnx")
+        export_dynamic_quantized_onnx_model(fp32, self.quantization, self.path)
+
+    def _load(self):
+        from sentence_transformers import SentenceTransformer
+        self.export()
+        return SentenceTransformer(self.path, backend="onnx", model_kwargs={"file_name": self.file_name})
+
+BACKENDS = {
+    "torch": Embedder,
+    "onnx": OnnxEmbedder,
+}
+
+_embedders = {}
+_embedders_lock = threading.Lock()
+
+def get_embedder(path: str = MODEL_PATH, backend: Optional[str] = None) -> Embedder:
+    """
+    The embedder of the model at `path` shared by the whole process, created on first request.
+    The backend defaults to EMBEDDING_BACKEND, `torch` when it is not set.
+    """
+    backend = backend or os.getenv("EMBEDDING_BACKEND") or "torch"
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown embedding backend {backend}, expected one of {', '.join(BACKENDS)}")
+    with _embedders_lock:
+        if (path, backend) not in _embedders:
+            _embedders[(path, backend)] = BACKENDS[backend].from_env(path)
+        return _embedders[(path, backend)]
@@ -0,0 +1,257 @@
+import os
+import re
+from typing import Callable, Iterable, Optional, Type, TypeVar
+
+# directory names that never hold first-party sources
+VENDORED_DIRS = {
+    ".git", ".hg", ".svn",
+    "venv", ".venv", "virtualenv",
+    "site-packages", "dist-packages", "node_modules", "bower_components",
+    "__pycache__", ".eggs", ".tox", ".nox",
+    ".mypy_cache", ".pytest_cache", ".ruff_cache", ".ipynb_checkpoints",
+}
+# build outputs and environments at the top of the repository, the same names deeper down are sources
+ROOT_VENDORED_DIRS = {"build", "dist", ".env"}
+IGNORED_FILES = {".git", ".gitignore"}   # .git is a file in worktrees
+GENERATED_SUFFIXES = ("_pb2.py", "_pb2_grpc.py", "_pb2.pyi", ".min.js", ".min.css")
+GENERATED_MARKERS = (b"@generated", b"do not edit", b"autogenerated", b"auto-generated", b"code generated by")
+MAX_FILE_SIZE = 1 << 20
+SIZE_CAPPED_EXTENSIONS = (".py",)
+
+# read(relpath) -> file content, or None when the file does not exist
+ReadFn = Callable[[str], Optional[bytes]]
+
+def approx_tokens(size: int) -> int:
+    """Rough token count of a source file, without reading it."""
+    return size // 4
+
+def _comment_banner(code: bytes, head_lines: int) -> bytes:
+    """The comment lines the file starts with, among its first `head_lines`."""
+    banner = []
+    for line in code.split(b"\n", head_lines)[:head_lines]:
+        line = line.strip()
+        if line and not line.startswith(b"#"):
+            break
+        banner.append(line)
+    return b"\n".join(banner).lower()
+
+def is_generated_source(code: bytes, head_lines: int = 5, max_line_length: int = 1000) -> bool:
+    """
+    Heuristics on the content: a generator banner in the leading comments, or minified code.
+    Markers in a docstring or in code do not count.
+    """
+    banner = _comment_banner(code, head_lines)
+    if any(marker in banner for marker in GENERATED_MARKERS):
+        return True
+    lines = code.count(b"\n") + 1
+    return len(code) > max_line_length and len(code) / lines > max_line_length
+
+def _glob_to_regex(pattern: str) -> str:
+    i = 0
+    r = ""
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            r += "(?:.*/)?"
+            i += 3
+            continue
+        if pattern.startswith("/**", i) and i + 3 == len(pattern):
+            r += "/.*"
+            i += 3
+            continue
+        if c == "*":
+            r += "[^/]*"
+        elif c == "?":
+            r += "[^/]"
+        elif c == "[":
+            j = pattern.find("]", i + 1)
+            if j == -1:
+                r += re.escape(c)
+            else:
+                body = pattern[i + 1:j].replace("\\", "\\\\")
+                r += f"[{'^' + body[1:] if body.startswith('!') else body}]"
+                i = j
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            r += re.escape(pattern[i])
+        else:
+            r += re.escape(c)
+        i += 1
+    return r
+
+class _Pattern:
+    """One line of a .gitignore or .gitattributes file, relative to the directory holding it."""
+    def __init__(self, pattern: str, base: str):
+        self.negated = pattern.startswith("!")
+        if self.negated:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        self.base = base
+        self.anchored = anchored
+        self.regex = re.compile(_glob_to_regex(pattern) + "$")
+
+    def match(self, relpath: str, is_dir: bool) -> bool:
+        if self.dir_only and not is_dir:
+            return False
+        if self.base != ".":
+            if not relpath.startswith(self.base + "/"):
+                return False
+            relpath = relpath[len(self.base) + 1:]
+        if self.anchored:
+            return self.regex.match(relpath) is not None
+        return self.regex.match(os.path.basename(relpath)) is not None
+
+def _parse_gitignore(content: str, base: str) -> list[_Pattern]:
+    patterns = []
+    for line in content.splitlines():
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        patterns.append(_Pattern(line, base))
+    return patterns
+
+def _parse_gitattributes(content: str, attributes: Iterable[str]) -> list[tuple[_Pattern, bool]]:
+    rules = []
+    for line in content.splitlines():
+        parts = line.split()
+        if len(parts) < 2 or parts[0].startswith("#"):
+            continue
+        for attr in parts[1:]:
+            name, _, value = attr.lstrip("-!").partition("=")
+            if name not in attributes:
+                continue
+            is_set = not attr.startswith(("-", "!")) and value.lower() not in ("false", "0")
+            rules.append((_Pattern(parts[0], "."), is_set))
+    return rules
+
+class IgnoreRule:
+    """A rule returns the reason to skip an entry, or None to keep it."""
+    def skip(self, relpath: str, is_dir: bool, size: int) -> Optional[str]:
+        raise NotImplementedError
+
+class VendoredDirRule(IgnoreRule):
+    """`dirs` are pruned at any depth, `root_dirs` only directly below the repository root."""
+    def __init__(
+            self,
+            dirs: Iterable[str] = VENDORED_DIRS,
+            files: Iterable[str] = IGNORED_FILES,
+            root_dirs: Iterable[str] = ROOT_VENDORED_DIRS
+    ):
+        self.dirs = set(dirs)
+        self.files = set(files)
+        self.root_dirs = set(root_dirs)
+
+    def skip(self, relpath: str, is_dir: bool, size: int) -> Optional[str]:
+        name = os.path.basename(relpath)
+        if is_dir:
+            vendored = name in self.dirs or name.endswith(".egg-info") or relpath in self.root_dirs
+            return "vendored" if vendored else None
+        return "ignored" if name in self.files else None
+
+class GeneratedNameRule(IgnoreRule):
+    def __init__(self, suffixes: Iterable[str] = GENERATED_SUFFIXES):
+        self.suffixes = tuple(suffixes)
+
+    def skip(self, relpath: str, is_dir: bool, size: int) -> Optional[str]:
+        return "generated" if not is_dir and relpath.endswith(self.suffixes) else None
+
+class SizeRule(IgnoreRule):
+    def __init__(self, max_size: int = MAX_FILE_SIZE, extensions: Iterable[str] = SIZE_CAPPED_EXTENSIONS):
+        self.max_size = max_size
+        self.extensions = tuple(extensions)
+
+    def skip(self, relpath: str, is_dir: bool, size: int) -> Optional[str]:
+        if is_dir or not relpath.endswith(self.extensions):
+            return None
+        return "too large" if size > self.max_size else None
+
+class GitignoreRule(IgnoreRule):
+    """Honours the .gitignore of the root and of every directory on the way down, loaded on demand."""
+    def __init__(self, read: ReadFn):
+        self.read = read
+        self.patterns = {}
+
+    def _patterns(self, dir: str) -> list[_Pattern]:
+        if dir not in self.patterns:
+            content = self.read(".gitignore" if dir == "." else f"{dir}/.gitignore")
+            self.patterns[dir] = _parse_gitignore(content.decode(errors="replace"), dir) if content else []
+        return self.patterns[dir]
+
+    def skip(self, relpath: str, is_dir: bool, size: int) -> Optional[str]:
+        parts = relpath.split("/")
+        dirs = ["."] + ["/".join(parts[:i]) for i in range(1, len(parts))]
+        ignored = False
+        for dir in dirs:
+            for pattern in self._patterns(dir):
+                if pattern.match(relpath, is_dir):
+                    ignored = not pattern.negated
+        return "gitignore" if ignored else None
+
+class GitattributesRule(IgnoreRule):
+    """Files marked linguist-generated or linguist-vendored in the root .gitattributes."""
+    def __init__(self, read: ReadFn, attributes: Iterable[str] = ("linguist-generated", "linguist-vendored")):
+        content = read(".gitattributes")
+        self.rules = _parse_gitattributes(content.decode(errors="replace"), set(attributes)) if content else []
+
+    def skip(self, relpath: str, is_dir: bool, size: int) -> Optional[str]:
+        if is_dir:
+            return None
+        marked = False
+        for pattern, is_set in self.rules:
+            if pattern.match(relpath, is_dir):
+                marked = is_set
+        return "gitattributes" if marked else None
+
+T = TypeVar('T', bound='IgnoreEngine')
+class IgnoreEngine:
+    """
+    Decides which entries of a repository walk are dropped, and keeps count of what was dropped.
+    Rules are tried in order and the first one giving a reason wins. Directories that are skipped
+    are pruned, nothing below them is visited.
+    """
+    def __init__(self, rules: list[IgnoreRule]):
+        self.rules = rules
+        self.skipped_files = {}
+        self.skipped_bytes = {}
+        self.pruned_dirs = {}
+
+    @classmethod
+    def default(cls: Type[T], read: ReadFn, max_file_size: int = MAX_FILE_SIZE) -> T:
+        return cls([
+            VendoredDirRule(),
+            GitignoreRule(read),
+            GitattributesRule(read),
+            GeneratedNameRule(),
+            SizeRule(max_file_size),
+        ])
+
+    def __call__(self, relpath: str, is_dir: bool, size: int = 0) -> bool:
+        for rule in self.rules:
+            reason = rule.skip(relpath, is_dir, size)
+            if reason is not None:
+                self.record(reason, is_dir, size)
+                return True
+        return False
+
+    def record(self, reason: str, is_dir: bool = False, size: int = 0):
+        if is_dir:
+            self.pruned_dirs[reason] = self.pruned_dirs.get(reason, 0) + 1
+        else:
+            self.skipped_files[reason] = self.skipped_files.get(reason, 0) + 1
+            self.skipped_bytes[reason] = self.skipped_bytes.get(reason, 0) + size
+
+    def summary(self) -> str:
+        files = sum(self.skipped_files.values())
+        tokens = approx_tokens(sum(self.skipped_bytes.values()))
+        dirs = sum(self.pruned_dirs.values())
+        lines = [f"skipped {files} files (~{tokens} tokens), pruned {dirs} directories"]
+        for reason in sorted(set(self.skipped_files) | set(self.pruned_dirs)):
+            lines.append(
+                f"  {reason}: {self.skipped_files.get(reason, 0)} files "
+                f"(~{approx_tokens(self.skipped_bytes.get(reason, 0))} tokens), "
+                f"{self.pruned_dirs.get(reason, 0)} directories"
+            )
+        return "\n".join(lines)
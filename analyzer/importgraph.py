@@ -0,0 +1,207 @@
+import heapq
+import json
+import os
+import pkgutil
+import sys
+import sysconfig
+from functools import lru_cache
+from typing import Iterable, Optional, Type, TypeVar
+from redis import Redis
+from parsing import CodeChunk
+from budget import is_test_path
+
+@lru_cache(maxsize=None)
+def external_modules() -> frozenset[str]:
+    """Top-level names of the standard library and of the packages installed next to it."""
+    names = set(sys.builtin_module_names) | set(getattr(sys, "stdlib_module_names", ()))
+    dirs = {sysconfig.get_path(name) for name in ("stdlib", "platstdlib", "purelib", "platlib")}
+    dirs |= {os.path.join(d, "lib-dynload") for d in set(dirs)}
+    names.update(module.name for module in pkgutil.iter_modules([d for d in dirs if d and os.path.isdir(d)]))
+    return frozenset(names)
+
+def packages(paths: Iterable[str]) -> set[str]:
+    """Directories with an `__init__.py`."""
+    return {os.path.dirname(path) for path in paths if os.path.basename(path) == "__init__.py"}
+
+def source_roots(paths: Iterable[str], package_dirs: set[str]) -> set[str]:
+    """
+    Directories absolute imports are resolved from: the repository root, top-level directories
+    that are not packages and the parent of every outermost package, like `src` of `src/pkg`.
+    """
+    roots = {""}
+    for path in paths:
+        top = path.split("/")[0]
+        if top != path and top not in package_dirs:
+            roots.add(top)
+    for package in package_dirs:
+        if os.path.dirname(package) not in package_dirs:
+            roots.add(os.path.dirname(package))
+    return roots
+
+def module_names(path: str, roots: set[str]) -> list[str]:
+    """Dotted names a file can be imported as from the source roots above it."""
+    parts = os.path.splitext(path)[0].split("/")
+    if parts[-1] == "__init__":
+        parts = parts[:-1]
+    r = []
+    for root in roots:
+        depth = len(root.split("/")) if root else 0
+        if depth < len(parts) and "/".join(parts[:depth]) == root:
+            r.append(".".join(parts[depth:]))
+    return r
+
+def _script_paths(module: str, importer: str) -> list[str]:
+    # a script finds modules next to it, its directory is the first entry of sys.path
+    base = "/".join([d for d in [os.path.dirname(importer)] if d] + module.split("."))
+    return [f"{base}.py", f"{base}/__init__.py"]
+
+def _resolve(module: str, importer: str) -> str:
+    if not module.startswith("."):
+        return module
+    level = len(module) - len(module.lstrip("."))
+    package = os.path.dirname(importer).split("/")
+    package = package[:len(package) - (level - 1)] if level > 1 else package
+    rest = module[level:]
+    return ".".join([p for p in package if p] + ([rest] if rest else []))
+
+T = TypeVar('T', bound='ImportGraph')
+class ImportGraph:
+    """
+    Which files of the repository import which, resolved from the Import records of the parse.
+    Absolute imports are looked up from the source roots and from the directory of the importing
+    file, as Python does for a script. A top-level name of the standard library or of an installed
+    package wins over a repository module that is not in a package, so `import logging` does not
+    pick up `scripts/logging.py`. Imports of modules outside the repository are dropped. Every
+    parsed file is a node, also when it imports nothing.
+    """
+    @classmethod
+    def from_codes(cls: Type[T], codes: list[CodeChunk]) -> T:
+        graph = cls({code.path: set() for code in codes})
+        graph.update(codes)
+        return graph
+
+    @classmethod
+    def from_redis(cls: Type[T], redis: Redis, key: str) -> Optional[T]:
+        stored = redis.hgetall(key)
+        if not stored:
+            return None
+        imports = {}
+        modules = {}
+        for path, value in stored.items():
+            value = json.loads(value)
+            if isinstance(value, list):
+                # saved before the import statements were kept, the edges stay as they are
+                imports[path] = set(value)
+            else:
+                imports[path] = set(value["imports"])
+                modules[path] = [(module, members) for module, members in value["modules"]]
+        return cls(imports, modules)
+
+    def __init__(self, imports: dict[str, set[str]], modules: Optional[dict[str, list[tuple[str, list[str]]]]] = None):
+        self.imports = imports      # path -> paths it imports
+        self.modules = modules if modules is not None else {}   # path -> (module, members) of its import statements
+
+    def __len__(self) -> int:
+        return len(self.imports)
+
+    def update(self, codes: list[CodeChunk], removed: Iterable[str] = ()):
+        """
+        Replace the import statements of the given files and drop removed files. The edges of
+        every file are resolved again, so a file importing a module that was just added or
+        renamed gets its edge without changing itself.
+        """
+        for path in removed:
+            self.imports.pop(path, None)
+            self.modules.pop(path, None)
+        for code in codes:
+            self.imports.setdefault(code.path, set())
+            self.modules[code.path] = [(imp.module, imp.members) for imp in code.imports]
+        package_dirs = packages(self.imports)
+        roots = source_roots(self.imports, package_dirs)
+        # top-level names the repository defines as packages, these shadow external modules
+        top_packages = {os.path.basename(package) for package in package_dirs if os.path.dirname(package) in roots}
+        external = external_modules() - top_packages
+        by_module = {}
+        for path in self.imports:
+            for name in module_names(path, roots):
+                by_module.setdefault(name, []).append(path)
+
+        for importer, modules in self.modules.items():
+            imported = set()
+            for name, members in modules:
+                if not name.startswith(".") and name.split(".")[0] in external:
+                    continue
+                module = _resolve(name, importer)
+                candidates = [module] + [f"{module}.{member}" for member in members]
+                for candidate in candidates:
+                    paths = by_module.get(candidate, [])
+                    if not name.startswith("."):
+                        paths = paths + [p for p in _script_paths(candidate, importer) if p in self.imports]
+                    for path in paths:
+                        if path != importer:
+                            imported.add(path)
+            self.imports[importer] = imported
+        for path in self.imports:
+            self.imports[path] &= self.imports.keys()
+
+    def _dumps(self, path: str) -> str:
+        if path not in self.modules:
+            return json.dumps(sorted(self.imports[path]))
+        return json.dumps({"imports": sorted(self.imports[path]), "modules": self.modules[path]})
+
+    def importers(self) -> dict[str, set[str]]:
+        r = {path: set() for path in self.imports}
+        for path, imported in self.imports.items():
+            for dep in imported:
+                r[dep].add(path)
+        return r
+
+    def fan_in(self) -> dict[str, int]:
+        """Number of other files importing each file."""
+        return {path: len(importers) for path, importers in self.importers().items()}
+
+    def order(self) -> list[str]:
+        """
+        Files with the files they import first, test files after all others. Among the files
+        whose imports are all placed, the ones with the highest fan-in go first. An import
+        cycle is broken at the file that would be picked first anyway.
+        """
+        fan_in = self.fan_in()
+        importers = self.importers()
+        r = []
+        for tests in (False, True):
+            group = {path for path in self.imports if is_test_path(path) == tests}
+            r += self._topological(group, importers, fan_in)
+        return r
+
+    def _topological(self, group: set[str], importers: dict[str, set[str]], fan_in: dict[str, int]) -> list[str]:
+        waiting = {path: len(self.imports[path] & group) for path in group}
+
+        def key(path: str):
+            return (-fan_in[path], path)
+
+        ready = [key(path) for path, n in waiting.items() if n == 0]
+        heapq.heapify(ready)
+        r = []
+        placed = set()
+        while len(r) < len(group):
+            if not ready:
+                path = min((p for p in group if p not in placed), key=key)
+                heapq.heappush(ready, key(path))
+            path = heapq.heappop(ready)[1]
+            if path in placed:
+                continue
+            placed.add(path)
+            r.append(path)
+            for importer in importers[path] & group:
+                waiting[importer] -= 1
+                if waiting[importer] == 0 and importer not in placed:
+                    heapq.heappush(ready, key(importer))
+        return r
+
+    def save(self, redis: Redis, key: str):
+        pipeline = redis.pipeline()
+        pipeline.delete(key)
+        if len(self.imports) > 0:
+            pipeline.hset(key, mapping={path: self._dumps(path) for path in self.imports})
+        pipeline.execute()
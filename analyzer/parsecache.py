@@ -0,0 +1,92 @@
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Type, TypeVar
+
+DEFAULT_MAX_BYTES = 1 << 30
+
+T = TypeVar('T', bound='ParseCache')
+class ParseCache:
+    """
+    On-disk cache of parse results, one file per key under a two level fan-out directory.
+    Entries are written to a temporary file and renamed into place, so concurrent builds never
+    see a partial entry. Reading an entry touches it, and `evict` removes least recently used
+    entries until the cache fits in `max_bytes`.
+    """
+    @classmethod
+    def from_env(cls: Type[T]) -> Optional[T]:
+        root = os.getenv("PARSE_CACHE_DIR")
+        if not root:
+            return None
+        return cls(root, int(os.getenv("PARSE_CACHE_MAX_BYTES") or DEFAULT_MAX_BYTES))
+
+    def __init__(self, root: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = Path(os.path.abspath(root))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass    # evicted by another build in the meantime, we still have the data
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits."""
+        entries = []
+        total = 0
+        for shard in self.root.iterdir():
+            if not shard.is_dir():
+                continue
+            with os.scandir(shard) as it:
+                for entry in it:
+                    if entry.name.startswith(".tmp-"):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, entry.path, st.st_size))
+                    total += st.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        rate = f" ({100 * self.hits / lookups:.1f}% hit rate)" if lookups else ""
+        return f"parse cache: {self.hits} hits, {self.misses} misses{rate}"
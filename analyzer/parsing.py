@@ -1,27 +1,66 @@
 import tree_sitter_python as tspython
-from tree_sitter import Language, Parser, Node
-from repo import RepoFile, Repository
-from dataclasses import dataclass
-from typing import TypeVar, Union
+from tree_sitter import Language, Parser, Node, Tree
+from repo import RepoFile, Repository, PARSABLE_EXTENSIONS
+from dataclasses import dataclass, field, replace
+from typing import Callable, Optional, TypeVar, Union
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from pickle import dumps, loads
+from hashlib import sha1
+from collections import OrderedDict
+from importlib.metadata import version
+from repo import blob_sha
+from ignore import is_generated_source
+from parsecache import ParseCache
+from sourcestore import Span
+
+# bump whenever the extracted chunks change, so cached parse results are not reused
+PARSER_VERSION = 4
+# the grammar decides the trees, so cached results of another grammar release are not reused either
+GRAMMAR_VERSION = f"tree-sitter-{version('tree-sitter')}-python-{version('tree-sitter-python')}"
 
 _parser = Parser(Language(tspython.language()))
 
-@dataclass
+def body_hash(body: str) -> str:
+    return sha1(body.encode()).hexdigest()
+
+def _text(source: bytes, start: int, end: int) -> str:
+    # decodes straight from a view of the source, no intermediate bytes copy
+    return str(memoryview(source)[start:end], "utf-8")
+
+def _node_text(source: bytes, node: Node) -> str:
+    return _text(source, node.start_byte, node.end_byte)
+
 class FunctionChunk:
-    name: str
-    decorator: str
-    body: str
+    """A function as a span of its file, the text stays in the source store."""
+    __slots__ = ("name", "decorator", "span", "body_start")
+
+    def __init__(self, name: str, decorator: str, span: Span, body_start: int):
+        self.name = name
+        self.decorator = decorator
+        self.span = span
+        self.body_start = body_start    # first byte of the block after the signature
 
 T = TypeVar('T', bound='ClassChunk')
-@dataclass
 class ClassChunk:
-    name: str
-    methods: list[FunctionChunk]
-    inner_classes: list[T]
-    decorator: str
-    body: str
+    """A class as a span of its file, methods and inner classes are spans inside it."""
+    __slots__ = ("name", "methods", "inner_classes", "decorator", "span", "body_start")
+
+    def __init__(
+            self,
+            name: str,
+            methods: list[FunctionChunk],
+            inner_classes: list[T],
+            decorator: str,
+            span: Span,
+            body_start: int
+    ):
+        self.name = name
+        self.methods = methods
+        self.inner_classes = inner_classes
+        self.decorator = decorator
+        self.span = span
+        self.body_start = body_start
 
 @dataclass
 class Import:
@@ -36,116 +75,316 @@ class CodeChunk:
     imports: list[Import]
     classes: list[ClassChunk]
     functions: list[FunctionChunk]
+    sha: str = ""   # git blob sha of the source file, the file id of every span
+    source: bytes = field(default=b"", repr=False)
     
-def _parse_decorated_def(node: Node) -> Union[FunctionChunk, ClassChunk]:
+def _span(node: Node, file: str) -> Span:
+    return Span(file, node.start_byte, node.end_byte, node.start_point[0] + 1, node.end_point[0] + 1)
+
+def _parse_decorated_def(node: Node, source: bytes, file: str) -> Optional[Union[FunctionChunk, ClassChunk]]:
     assert node.type == "decorated_definition"
-    decorator = node.children[0].text.decode()
     d = node.child_by_field_name("definition")
     
     if d.type == "function_definition":
-        f = _parse_function_def(d)
-        f.decorator = decorator
-        f.body = node.text.decode()
-        return f
+        chunk = _parse_function_def(d, source, file)
     elif d.type == "class_definition":
-        c = _parse_class_def(d)
-        c.decorator = decorator
-        c.body = node.text.decode()
-        return c
+        chunk = _parse_class_def(d, source, file)
+    else:
+        return None
+    chunk.decorator = _node_text(source, node.children[0])
+    chunk.span.start_byte = node.start_byte
+    chunk.span.start_line = node.start_point[0] + 1
+    return chunk
 
-def _parse_function_def(node: Node) -> FunctionChunk:
+def _parse_function_def(node: Node, source: bytes, file: str) -> FunctionChunk:
     return FunctionChunk(
-        node.child_by_field_name("name").text.decode(),
+        _node_text(source, node.child_by_field_name("name")),
         "",
-        node.text.decode()
+        _span(node, file),
+        node.child_by_field_name("body").start_byte
     )
 
-def _parse_class_def(node: Node):
+def _parse_class_def(node: Node, source: bytes, file: str) -> ClassChunk:
     assert node.type == "class_definition"
-    name = node.child_by_field_name("name").text.decode()
-    body = node.child_by_field_name("body").children
+    name = _node_text(source, node.child_by_field_name("name"))
     methods = []
     inner_classes = []
-    for child in filter(lambda nd: nd.type == "function_definition", body):
-        methods.append(_parse_function_def(child))
-    for child in filter(lambda nd: nd.type == "class_definition", body):
-        inner_classes.append(_parse_class_def(child))
-    for child in filter(lambda nd: nd.type == "decorated_definition", body):
-        chunk = _parse_decorated_def(child)
-        if isinstance(chunk, FunctionChunk):
-            methods.append(chunk)
-        elif isinstance(chunk, ClassChunk):
-            methods.append(chunk)
+    body = node.child_by_field_name("body")
+    cursor = body.walk()
+    if cursor.goto_first_child():
+        while True:
+            child = cursor.node
+            if child.type == "function_definition":
+                methods.append(_parse_function_def(child, source, file))
+            elif child.type == "class_definition":
+                inner_classes.append(_parse_class_def(child, source, file))
+            elif child.type == "decorated_definition":
+                chunk = _parse_decorated_def(child, source, file)
+                if isinstance(chunk, FunctionChunk):
+                    methods.append(chunk)
+                elif isinstance(chunk, ClassChunk):
+                    inner_classes.append(chunk)
+            if not cursor.goto_next_sibling():
+                break
 
     return ClassChunk(
         name,
         methods,
         inner_classes,
         "",
-        node.text.decode()
+        _span(node, file),
+        body.start_byte
     )
 
-def _parse_module_name(node: Node):
+def _parse_module_name(node: Node, source: bytes):
     if node.type == "aliased_import":
-        return node.child_by_field_name("name").text.decode(), \
-               node.child_by_field_name("alias").text.decode()
+        return _node_text(source, node.child_by_field_name("name")), \
+               _node_text(source, node.child_by_field_name("alias"))
     elif node.type == "dotted_name" or node.type == "relative_import":
-        return node.text.decode(), ""
+        return _node_text(source, node), ""
 
 def parse_code(file: RepoFile) -> CodeChunk:
     assert file.is_file
-    assert file.type == ".py"
+    assert file.type in PARSABLE_EXTENSIONS
+
+    return parse_source(file.read("rb"), file.relpath, file.name)
+
+# (old start, old count, new start, new count) line numbers of a `git diff -U0` hunk
+Hunk = tuple[int, int, int, int]
+
+class TreeCache:
+    """
+    Syntax trees of recently parsed files by blob sha, with their source, so the next version
+    of a file can be parsed incrementally. A tree that is not cached, after a build or a restart,
+    is parsed from the blob `load` returns for its sha. Least recently used trees are dropped
+    once the sources add up to more than `max_bytes`.
+    """
+    def __init__(self, max_bytes: int = 256 * (1 << 20), load: Optional[Callable[[str], Optional[bytes]]] = None):
+        self.max_bytes = max_bytes
+        self.load = load
+        self.size = 0
+        self._trees = OrderedDict()
 
-    with open(file.path, "rb") as f:
-        code =  f.read()
-    tree = _parser.parse(code)
+    def get(self, sha: str) -> Optional[tuple[Tree, bytes]]:
+        entry = self._trees.get(sha)
+        if entry is not None:
+            self._trees.move_to_end(sha)
+            return entry
+        code = self.load(sha) if self.load is not None else None
+        if code is None:
+            return None
+        self.put(sha, _parser.parse(code), code)
+        return self._trees.get(sha)
+
+    def put(self, sha: str, tree: Tree, code: bytes):
+        if sha in self._trees:
+            self._trees.move_to_end(sha)
+            return
+        self._trees[sha] = (tree, code)
+        self.size += len(code)
+        while self.size > self.max_bytes and len(self._trees) > 1:
+            _, (_, evicted) = self._trees.popitem(last=False)
+            self.size -= len(evicted)
+
+def _line_offsets(code: bytes) -> list[int]:
+    # byte offset of the start of every line, and the end of the code
+    offsets = [0]
+    i = code.find(b"\n")
+    while i != -1:
+        offsets.append(i + 1)
+        i = code.find(b"\n", i + 1)
+    if offsets[-1] != len(code):
+        offsets.append(len(code))
+    return offsets
+
+def parse_incremental(
+        code: bytes,
+        path: str,
+        name: str,
+        old_sha: Optional[str],
+        hunks: list[Hunk],
+        trees: TreeCache
+) -> tuple[CodeChunk, Optional[list[tuple[int, int]]]]:
+    """
+    Parse a new version of a file. When the tree of the old version is in `trees`, or can be
+    loaded into it, the diff hunks are applied to a copy of it as edits and tree-sitter reuses
+    every unchanged subtree. Returns the chunk and the byte ranges of `code` that changed, None
+    when the whole file was parsed from scratch. The new tree replaces the old one in `trees`.
+    """
+    cached = trees.get(old_sha) if old_sha is not None else None
+    changed = None
+    if cached is None:
+        tree = _parser.parse(code)
+    else:
+        old_tree, old_code = cached
+        edited = old_tree.copy()
+        old_lines = _line_offsets(old_code)
+        new_lines = _line_offsets(code)
+        changed = []
+        # from the last hunk back, so the text before each hunk still has its old offsets
+        for old_start, old_count, new_start, new_count in reversed(hunks):
+            # a hunk with zero lines sits after its start line
+            old_row = old_start - 1 if old_count > 0 else old_start
+            new_row = new_start - 1 if new_count > 0 else new_start
+            start = old_lines[old_row]
+            new_size = new_lines[new_row + new_count] - new_lines[new_row]
+            edited.edit(
+                start_byte=start,
+                old_end_byte=old_lines[old_row + old_count],
+                new_end_byte=start + new_size,
+                start_point=(old_row, 0),
+                old_end_point=(old_row + old_count, 0),
+                new_end_point=(old_row + new_count, 0)
+            )
+            changed.append((new_lines[new_row], new_lines[new_row + new_count]))
+        tree = _parser.parse(code, edited)
+        changed += [(r.start_byte, r.end_byte) for r in edited.changed_ranges(tree)]
+    chunk = _extract(tree, code, path, name)
+    trees.put(chunk.sha, tree, code)
+    return chunk, changed
+
+def touched(chunk: Union[FunctionChunk, ClassChunk], changed: list[tuple[int, int]]) -> bool:
+    """Whether the definition overlaps one of the changed byte ranges of parse_incremental."""
+    return any(start <= chunk.span.end_byte and chunk.span.start_byte <= end for start, end in changed)
+
+def parse_source(code: bytes, path: str, name: str) -> CodeChunk:
+    return _extract(_parser.parse(code), code, path, name)
+
+def _extract(tree: Tree, code: bytes, path: str, name: str) -> CodeChunk:
+    """
+    Collect top-level definitions and imports in one pass of a TreeCursor. Definitions are not
+    descended into, and they only keep byte offsets into `code` until their text is needed.
+    """
+    file = blob_sha(code)
     imports = []
     classes = []
     functions = []
 
-    def traverse(node: Node):
+    cursor = tree.walk()
+    while True:
+        node = cursor.node
+        descend = False
         if node.type == "class_definition":         # class
-            classes.append(_parse_class_def(node))
+            classes.append(_parse_class_def(node, code, file))
         elif node.type == "function_definition":    # function
-            functions.append(_parse_function_def(node))
+            functions.append(_parse_function_def(node, code, file))
         elif node.type == "import_statement":       # import X
-            name, alias = _parse_module_name(node.child_by_field_name("name"))
+            module, alias = _parse_module_name(node.child_by_field_name("name"), code)
             imports.append(Import(
-                name, alias, []
+                module, alias, []
             ))
         elif node.type == "import_from_statement":  # from A import B, C, ...
-            name, alias = _parse_module_name(node.child_by_field_name("module_name"))
+            module, alias = _parse_module_name(node.child_by_field_name("module_name"), code)
             members = list(map(
-                lambda nd: nd.text.decode(),
+                lambda nd: _node_text(code, nd),
                 node.children_by_field_name("name")
             ))
             imports.append(Import(
-                name, alias, members
+                module, alias, members
             ))
         elif node.type == "decorated_definition":
-            chunk = _parse_decorated_def(node)
+            chunk = _parse_decorated_def(node, code, file)
             if isinstance(chunk, FunctionChunk):
                 functions.append(chunk)
             elif isinstance(chunk, ClassChunk):
                 classes.append(chunk)
         else:
-            for child in node.children:
-                traverse(child)
+            descend = True
 
-    traverse(tree.root_node)
+        if descend and cursor.goto_first_child():
+            continue
+        while not cursor.goto_next_sibling():
+            if not cursor.goto_parent():
+                return CodeChunk(
+                    path,
+                    name,
+                    imports,
+                    classes,
+                    functions,
+                    file,
+                    code
+                )
 
-    return CodeChunk(
-        file.relpath,
-        file.name,
-        imports,
-        classes,
-        functions
-    )
+def _init_worker():
+    # every worker process gets its own parser
+    global _parser
+    _parser = Parser(Language(tspython.language()))
+
+def _parse_batch(batch: list[tuple[bytes, str, str]]) -> list[CodeChunk]:
+    # the caller still has every source, so it is not pickled back from pool workers
+    return list(map(lambda job: replace(parse_source(*job), source=b""), batch))
+
+def _batches(jobs: list[tuple[bytes, str, str]], batch_bytes: int) -> list[list[tuple[bytes, str, str]]]:
+    r = []
+    sub = []
+    size = 0
+    for job in jobs:
+        if size + len(job[0]) > batch_bytes and len(sub) > 0:
+            r.append(sub)
+            sub = []
+            size = 0
+        sub.append(job)
+        size += len(job[0])
+    if len(sub) > 0:
+        r.append(sub)
+    return r
+
+def parse(
+        repo: Repository,
+        processes: int = 1,
+        batch_bytes: int = 256*1024,
+        cache: Optional[ParseCache] = None
+) -> list[CodeChunk]:
+    """
+    Parse every parsable file. Files with identical content (same git blob sha) are
+    parsed once and the result is recorded under each of their paths. Files whose
+    content looks generated are skipped and counted in repo.ignore.
+    With a cache, results are looked up by blob sha and parser version first and
+    only the files missing from it are parsed.
+    With processes > 1 the files are spread over a process pool in batches of about
+    `batch_bytes` of source, results keep the order of the repository index.
+    """
+    jobs = []
+    keys = []
+    order = []
+    first = {}
+    parsed = {}
+    for ext in PARSABLE_EXTENSIONS:
+        for f in repo.index.by_type(ext):
+            code = f.read("rb")
+            if is_generated_source(code):
+                repo.ignore.record("generated", size=len(code))
+                continue
+            sha = blob_sha(code)
+            if sha not in first:
+                first[sha] = len(first)
+                key = f"{sha}-v{PARSER_VERSION}-{GRAMMAR_VERSION}"
+                data = cache.get(key) if cache is not None else None
+                if data is not None:
+                    # entries hold the spans only, the source is the blob we just read
+                    parsed[first[sha]] = replace(loads(data), source=code)
+                else:
+                    jobs.append((code, f.relpath, f.name))
+                    keys.append((first[sha], key))
+            order.append((first[sha], f.relpath, f.name))
+
+    if processes > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker) as executor:
+            batches = executor.map(_parse_batch, _batches(jobs, batch_bytes))
+            fresh = [chunk for batch in batches for chunk in batch]
+    else:
+        fresh = _parse_batch(jobs)
+    for (i, key), job, chunk in zip(keys, jobs, fresh):
+        chunk.source = job[0]
+        parsed[i] = chunk
+        if cache is not None:
+            cache.put(key, dumps(replace(chunk, source=b"")))
+    if cache is not None:
+        cache.evict()
+        print(cache.summary())
 
-def parse(repo: Repository) -> list[CodeChunk]:
     chunks = []
-    for f in repo.files:
-        if not f.is_file or f.type != ".py":
-            continue
-        chunks.append(parse_code(f))
+    for i, path, name in order:
+        chunk = parsed[i]
+        chunks.append(chunk if chunk.path == path else replace(chunk, path=path, name=name))
     return chunks
@@ -0,0 +1,129 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Optional
+
+_DONE = object()
+
+class Stage:
+    """
+    One step of a Pipeline, `fn` is called on every item by `workers` threads. A stage that
+    collects items returns None until it has enough, `flush` hands on what is left at the end.
+    """
+    def __init__(
+            self,
+            name: str,
+            fn: Callable[[Any], Any],
+            workers: int = 1,
+            flush: Optional[Callable[[], Any]] = None
+    ):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.flush = flush
+        self.items = 0
+        self.busy = 0.0     # seconds spent in fn, summed over workers
+        self._lock = threading.Lock()
+
+    def _count(self, elapsed: float):
+        with self._lock:
+            self.items += 1
+            self.busy += elapsed
+
+class Pipeline:
+    """
+    Stages connected by bounded queues, every stage runs in its own threads so that they overlap.
+    Items are handed from one stage to the next as soon as they are done, in no particular order,
+    and a full queue blocks the stage feeding it. The output of the last stage is dropped.
+    The first error stops the source, the remaining items are drained and the error is raised.
+    """
+    def __init__(self, stages: list[Stage], queue_size: int = 8, source_name: str = "source"):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.source = Stage(source_name, None)
+        self.elapsed = 0.0
+        self._error = None
+        self._error_lock = threading.Lock()
+
+    def run(self, source: Iterable[Any]):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+        lock = threading.Lock()
+
+        def work(i: int):
+            stage = self.stages[i]
+            inq = queues[i]
+            outq = queues[i + 1] if i + 1 < len(queues) else None
+            while True:
+                item = inq.get()
+                if item is _DONE:
+                    break
+                if self._error is not None:
+                    continue
+                start = time.perf_counter()
+                try:
+                    out = stage.fn(item)
+                except BaseException as e:
+                    self._fail(e)
+                    continue
+                stage._count(time.perf_counter() - start)
+                if outq is not None and out is not None:
+                    outq.put(out)
+            with lock:
+                remaining[i] -= 1
+                last = remaining[i] == 0
+            if last and stage.flush is not None and self._error is None:
+                try:
+                    out = stage.flush()
+                except BaseException as e:
+                    self._fail(e)
+                    out = None
+                if outq is not None and out is not None:
+                    outq.put(out)
+            if last and outq is not None:
+                for _ in range(self.stages[i + 1].workers):
+                    outq.put(_DONE)
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                t = threading.Thread(target=work, args=(i,), name=f"pipeline-{stage.name}", daemon=True)
+                t.start()
+                threads.append(t)
+
+        start = time.perf_counter()
+        it = iter(source)
+        try:
+            while self._error is None:
+                produce = time.perf_counter()
+                item = next(it, _DONE)
+                if item is _DONE:
+                    break
+                self.source._count(time.perf_counter() - produce)
+                queues[0].put(item)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+            for t in threads:
+                t.join()
+        self.elapsed = time.perf_counter() - start
+        if self._error is not None:
+            raise self._error
+
+    def _fail(self, e: BaseException):
+        with self._error_lock:
+            if self._error is None:
+                self._error = e
+
+    def summary(self) -> str:
+        lines = [f"pipeline: {self.elapsed:.1f}s wall clock"]
+        for stage in [self.source] + self.stages:
+            rate = stage.items / stage.busy if stage.busy > 0 else 0.0
+            utilization = 100 * stage.busy / (self.elapsed * stage.workers) if self.elapsed > 0 else 0.0
+            lines.append(
+                f"  {stage.name:<10} {stage.items:6d} items, {stage.busy:8.1f}s busy, "
+                f"{rate:8.1f} items/s per worker, {utilization:5.1f}% of {stage.workers} workers"
+            )
+        return "\n".join(lines)
@@ -22,8 +22,18 @@ def get_content(s: str, tag: str) -> Optional[str]:
 
 sep_token = '###'
 
-def get_summarization_prompt(bodies: Iterable[str]) -> tuple[str, str]:
+# bump on every change of get_summarization_prompt, cached descriptions of other versions are not reused
+SUMMARIZATION_PROMPT_VERSION = 3
+
+def get_summarization_prompt(bodies: Iterable[str], context: str = "") -> tuple[str, str]:
     bodies = sep_token.join(bodies)
+    if context:
+        context = f'''Summaries of the modules these code blocks import, for context only. Do not summarize them:
+<dependencies>
+{context}
+</dependencies>
+
+'''
     system = \
 f'''You are a code summarizer for a retrieval augmented generation (RAG) system. Your task is to analyze each provided code block—which may contain functions, classes, or other programming constructs—and generate a concise yet information-rich summary. Each summary should capture:
 - The primary purpose of the code.
@@ -32,6 +42,7 @@ f'''You are a code summarizer for a retrieval augmented generation (RAG) system.
 - Noteworthy implementation details or constraints.
 
 The code blocks are provided as text with each block delimited by the delimiter `{sep_token}`. Use these markers to identify and extract each code block for analysis.
+Classes are given as skeletons: method and inner class bodies are replaced by `...` because they are summarized separately. Summarize the role of the class and refer to its methods by name.
 
 **Important:** Your final output must be a single string containing the summaries for all code blocks separated by the delimiter `{sep_token}`, and no additional text or information.
 **Important:** The number of summaries must be same with the number of code blocks.
@@ -44,7 +55,7 @@ Remember: The final output must strictly be a single string with each summary se
 Example Output:
 Function 'calculate_factorial' computes the factorial of a number using recursion and handles edge cases effectively.{sep_token}Class 'BinarySearchTree' implements a binary search tree with methods for node insertion, deletion, and search, while supporting in-order traversal for sorted output.
 
-Text with Code Blocks:
+{context}Text with Code Blocks:
 {bodies}
 '''
     return system, user
@@ -133,8 +144,16 @@ Provide your summary in the following format:
 Remember, your summary and key points should only contain information present in the original README. The search terms should be concise phrases or keywords that capture the main concepts discussed in the README and are relevant to the user's query.'''
     return system, user
 
-def get_answer_generation_prompt(query: str, output_format: str, readme: str, directories: Iterable[str], codes: Iterable) -> tuple[str, str]:
+def get_answer_generation_prompt(
+        query: str,
+        output_format: str,
+        readme: str,
+        directories: Iterable[str],
+        codes: Iterable,
+        dependencies: Iterable[str] = ()
+) -> tuple[str, str]:
     directories = "\n".join(map(lambda dir: f"- {dir}", directories))
+    dependencies = "\n".join(map(lambda dep: f"- {dep}", dependencies))
     code_snippets = "\n".join(map(
         lambda x: f'<code_snippet path="{x.path}" name={x.name}>{x.body}</code_snippet>',
         codes
@@ -155,6 +174,10 @@ f'''Here's the information you have:
 {code_snippets}
 </code_snippets>
 
+<module_dependencies>
+{dependencies}
+</module_dependencies>
+
 The user's query is:
 <user_query>
 {query}
@@ -162,7 +185,7 @@ The user's query is:
 
 To answer the query, follow these steps:
 
-1. Carefully analyze the provided README summary, directory list (exclude hidden directories starts with .), and code snippets.
+1. Carefully analyze the provided README summary, directory list (exclude hidden directories starts with .), code snippets, and the imports between the files of the snippets.
 2. Focus only on the information directly related to the user's query.
 3. If the query cannot be answered with the given information, exclude that part from answer.
 4. Do not make assumptions or include any information not present in the provided context.
@@ -1,17 +1,37 @@
 import re
 import json
-from typing import Optional, List, Dict, Type, TypeVar, Union
+from typing import Optional, List, Dict, TextIO, Tuple, Type, TypeVar, Union
 from github import Github
-from git import Repo
+from git import Repo, Tree
 from pathlib import Path
+from types import MappingProxyType
+from enum import Enum
+from hashlib import sha1
+from array import array
+from repotree import RepoTree, SkipFn, DIR_TYPE
+from ignore import IgnoreEngine, MAX_FILE_SIZE
+from clonecache import CloneCache
 import os
 
 REPO_PATH = "./repo"
 IGNORE_DIRS = [".git"]
 IGNORE_FILES = [".gitignore"]
+PARSABLE_EXTENSIONS = [".py"]
+README_PATTERNS = ["README*", "readme*"]
+
+class CloneMode(Enum):
+    FULL = "full"       # every commit and blob, full working tree
+    SPARSE = "sparse"   # depth 1, blob:none filter, only parsable files and READMEs checked out
+    BARE = "bare"       # depth 1 bare clone, files are read from the object database
+
+def blob_sha(data: bytes) -> str:
+    """Object id git gives to a blob with this content."""
+    return sha1(b"blob %d\0" % len(data) + data).hexdigest()
 
 T = TypeVar('T', bound='RepoFile')
 class RepoFile:
+    __slots__ = ("_path", "_is_file", "_entries", "_name", "_type", "_size", "_relpath")
+
     def __init__(self, path: Path):
         self._path = path
         self._is_file = self._path.is_file()
@@ -19,6 +39,7 @@ class RepoFile:
         self._name = self._path.name
         self._type = "dir" if self.is_dir else self._path.suffix
         self._size = self._path.stat().st_size
+        self._relpath = None
         if not self.is_file:
             for entry in self._path.iterdir():
                 if entry.is_dir() and entry.name not in IGNORE_DIRS:
@@ -49,7 +70,9 @@ class RepoFile:
         return str(self._path.resolve())
     @property
     def relpath(self) -> str:
-        return str(os.path.relpath(self.path, REPO_PATH))
+        if self._relpath is None:
+            self._relpath = str(os.path.relpath(self.path, REPO_PATH))
+        return self._relpath
     @property
     def name(self) -> str:
         return self._name
@@ -78,50 +101,326 @@ class RepoFile:
     def dir_entries(self) -> List[T]:
         return list(filter(lambda e: e.is_dir, self.entries))
     
+class TreeNode(RepoFile):
+    """
+    View of one node of a RepoTree with the RepoFile interface. Views hold nothing but the
+    tree and the node index, so they are cheap to create and to throw away.
+    """
+    __slots__ = ("_tree", "_idx")
+
+    def __init__(self, tree: RepoTree, idx: int):
+        self._tree = tree
+        self._idx = idx
+
+    def to_json(self, indent=None) -> str:
+        if indent is not None:
+            return json.dumps(self.to_dict(), indent=indent)
+        return "".join(self._tree.iter_json(self._idx))
+
+    def write_json(self, fp: TextIO):
+        self._tree.write_json(fp, self._idx)
+
+    def read(self, mode = 'r') -> Union[str, bytes]:
+        data = self._tree.read(self._idx)
+        return data if "b" in mode else data.decode()
+
+    @property
+    def path(self) -> str:
+        return self._tree.path(self._idx)
+    @property
+    def relpath(self) -> str:
+        return self._tree.relpath(self._idx)
+    @property
+    def name(self) -> str:
+        return self._tree.name(self._idx)
+    @property
+    def type(self) -> str:
+        return self._tree.type(self._idx)
+    @property
+    def size(self) -> int:
+        return self._tree.size(self._idx)
+    @property
+    def is_dir(self) -> bool:
+        return self._tree.is_dir(self._idx)
+    @property
+    def is_file(self) -> bool:
+        return not self._tree.is_dir(self._idx)
+    @property
+    def hexsha(self) -> Optional[str]:
+        return self._tree.hexsha(self._idx)
+    @property
+    def entry_paths(self) -> List[Path]:
+        return list(map(lambda i: Path(self._tree.path(i)), self._tree.children(self._idx)))
+    @property
+    def entries(self) -> List[T]:
+        return list(map(lambda i: TreeNode(self._tree, i), self._tree.children(self._idx)))
+
+I = TypeVar('I', bound='RepoIndex')
+class RepoIndex:
+    """
+    Immutable snapshot of a cloned repository, built by a single walk into a RepoTree.
+    Nodes are numbered in pre-order (entries sorted by name), lookups by type and README
+    candidates are precomputed and every accessor hands out TreeNode views.
+    """
+    @classmethod
+    def from_path(cls: Type[I], path: Path, skip: Optional[SkipFn] = None) -> I:
+        return cls(RepoTree.from_path(str(path), skip=skip))
+
+    @classmethod
+    def from_tree(cls: Type[I], tree: Tree, skip: Optional[SkipFn] = None) -> I:
+        return cls(RepoTree.from_git_tree(tree, skip=skip))
+
+    def __init__(self, tree: RepoTree):
+        by_type = {}
+        for i in range(len(tree)):
+            by_type.setdefault(tree.type(i), array("I")).append(i)
+        files = array("I", (i for i in range(len(tree)) if not tree.is_dir(i)))
+        readmes = [i for i in files if "README" in tree.relpath(i)]
+        readmes.sort(key=lambda i: len(tree.relpath(i)))
+
+        self._tree = tree
+        self._files = files
+        self._by_type = MappingProxyType(by_type)
+        self._readmes = tuple(readmes)
+
+    def get(self, relpath: str) -> Optional[RepoFile]:
+        idx = self._tree.find(os.path.normpath(relpath))
+        return TreeNode(self._tree, idx) if idx is not None else None
+
+    def by_type(self, type: str) -> Tuple[RepoFile, ...]:
+        return self._views(self._by_type.get(type, ()))
+
+    def __contains__(self, relpath: str) -> bool:
+        return self._tree.find(os.path.normpath(relpath)) is not None
+
+    def __len__(self) -> int:
+        return len(self._tree)
+
+    def _views(self, idxs) -> Tuple[RepoFile, ...]:
+        return tuple(map(lambda i: TreeNode(self._tree, i), idxs))
+
+    @property
+    def tree(self) -> RepoTree:
+        return self._tree
+    @property
+    def root(self) -> RepoFile:
+        return TreeNode(self._tree, 0)
+    @property
+    def all(self) -> Tuple[RepoFile, ...]:
+        return self._views(range(len(self._tree)))
+    @property
+    def files(self) -> Tuple[RepoFile, ...]:
+        return self._views(self._files)
+    @property
+    def directories(self) -> Tuple[RepoFile, ...]:
+        return self.by_type(DIR_TYPE)
+    @property
+    def readmes(self) -> Tuple[RepoFile, ...]:
+        return self._views(self._readmes)
+    @property
+    def readme(self) -> Optional[RepoFile]:
+        return TreeNode(self._tree, self._readmes[0]) if len(self._readmes) > 0 else None
+
 class Repository:
-    def __init__(self, url: str):
+    def __init__(
+            self,
+            url: str,
+            clone_mode: Union[CloneMode, str] = CloneMode.FULL,
+            repo_path: str = REPO_PATH,
+            max_file_size: int = MAX_FILE_SIZE,
+            cache: Optional[CloneCache] = None
+    ):
+        self.url = url
         self.id = Repository.extract_id(url)
         self.repo = Github().get_repo(self.id) if self.id else None
-        self.repo_path = Path(REPO_PATH)
+        self.repo_path = Path(repo_path)
+        self.clone_mode = CloneMode(clone_mode)
+        self.max_file_size = max_file_size
+        self.cache = cache
         self.cloned_repo = None
+        self.ignore = None
+        self._index = None
     
     def clone(self):
-        if self.repo_path.exists():
-            self.cloned_repo = Repo(REPO_PATH)
+        if self.cache is not None and self.clone_mode == CloneMode.BARE:
+            # read straight from the shared mirror, leased so it is not evicted while we use it
+            self.repo_path = self.cache.mirror(self.clone_url, lease=True)
+            self.cloned_repo = Repo(self.repo_path)
+        elif self.cache is not None:
+            sparse_patterns = Repository.sparse_patterns() if self.clone_mode == CloneMode.SPARSE else None
+            self.cloned_repo = self.cache.checkout(self.clone_url, self.repo_path, sparse_patterns)
+        elif self.repo_path.exists():
+            self.cloned_repo = Repo(self.repo_path)
+        elif self.clone_mode == CloneMode.SPARSE:
+            self.cloned_repo = Repository.sparse_clone(self.clone_url, self.repo_path)
+        elif self.clone_mode == CloneMode.BARE:
+            self.cloned_repo = Repo.clone_from(self.clone_url, self.repo_path, bare=True, depth=1)
         else:
-            self.cloned_repo = Repo.clone_from(self.repo.clone_url, REPO_PATH)
+            self.cloned_repo = Repo.clone_from(self.clone_url, self.repo_path)
+        self.invalidate()
+
+    @staticmethod
+    def sparse_clone(url: str, path: Union[str, Path]) -> Repo:
+        """
+        Shallow partial clone which only downloads the blobs of the files we read.
+        `--sparse` checks out top-level files only, the following `sparse-checkout set`
+        widens it to the parsable extensions and README files and lazily fetches their blobs.
+        Directories without any of these files are not materialised.
+        """
+        cloned = Repo.clone_from(url, path, depth=1, filter="blob:none", sparse=True)
+        cloned.git.sparse_checkout("set", "--no-cone", *Repository.sparse_patterns())
+        return cloned
+
+    @staticmethod
+    def sparse_patterns() -> List[str]:
+        return [f"*{ext}" for ext in PARSABLE_EXTENSIONS] + README_PATTERNS
+
+    def pull(self):
+        """Fetch the remote HEAD and move the working tree to it."""
+        assert self.cloned_repo is not None
+        if self.cache is not None:
+            mirror = self.cache.mirror(self.clone_url)
+            if self.cloned_repo.bare:
+                # the mirror itself, its refs were just fetched
+                self.invalidate()
+                return
+            self.cloned_repo.git.fetch(str(mirror), "HEAD")
+        else:
+            args = ["--depth=1"] if self._is_shallow else []
+            self.cloned_repo.git.fetch("origin", "HEAD", *args)
+        if self.cloned_repo.bare:
+            self.cloned_repo.git.update_ref("HEAD", "FETCH_HEAD")
+        else:
+            self.cloned_repo.git.reset("--hard", "FETCH_HEAD")
+        self.invalidate()
+
+    def read_blob(self, sha: str) -> Optional[bytes]:
+        """Content of a blob by its sha, None when the object database does not have it."""
+        assert self.cloned_repo is not None
+        try:
+            return self.cloned_repo.odb.stream(bytes.fromhex(sha)).read()
+        except ValueError:
+            return None
+
+    def changed_files(self, old: str, new: str = "HEAD") -> List[Tuple[str, str]]:
+        """
+        (status, relpath) of every file that differs between two commits, status is one of git's
+        A/M/D/T letters. Renames are reported as a deletion plus an addition.
+        """
+        assert self.cloned_repo is not None
+        try:
+            self.cloned_repo.commit(old)
+        except ValueError:
+            # a shallow clone made after the index was built does not have the old commit yet
+            self.cloned_repo.git.fetch("origin", old, "--depth=1")
+        output = self.cloned_repo.git.diff("--name-status", "--no-renames", old, new)
+        changes = []
+        for line in output.splitlines():
+            status, path = line.split("\t", 1)
+            changes.append((status, path))
+        return changes
+
+    def diff_hunks(self, old: str, new: str = "HEAD", paths: List[str] = ()) -> Dict[str, Tuple[str, List[Tuple[int, int, int, int]]]]:
+        """
+        Old blob sha and the `git diff -U0` hunks of every changed file among `paths`. A hunk is
+        (old start, old count, new start, new count) in lines, the sha is None for added files.
+        """
+        assert self.cloned_repo is not None
+        if len(paths) == 0:
+            return {}
+        output = self.cloned_repo.git.diff("-U0", "--no-renames", "--full-index", "--no-color", old, new, "--", *paths)
+        diffs = {}
+        old_sha = None
+        hunks = None
+        for line in output.splitlines():
+            if line.startswith("index "):
+                old_sha = line.split()[1].split("..")[0]
+                old_sha = None if set(old_sha) == {"0"} else old_sha
+            elif line.startswith("+++ ") or line.startswith("--- "):
+                if line[4:].startswith(("a/", "b/")):
+                    hunks = []
+                    diffs[line[6:]] = (old_sha, hunks)
+            elif line.startswith("@@ ") and hunks is not None:
+                old_range, new_range = line.split(" ")[1:3]
+                old_start, _, old_count = old_range[1:].partition(",")
+                new_start, _, new_count = new_range[1:].partition(",")
+                hunks.append((int(old_start), int(old_count or 1), int(new_start), int(new_count or 1)))
+            elif line.startswith("diff --git"):
+                old_sha = None
+                hunks = None
+        return diffs
+
+    def close(self):
+        """Give the clone back to the cache, a checkout of the mirror is deleted."""
+        if self.cache is None or self.cloned_repo is None:
+            return
+        if not self.cloned_repo.bare:
+            self.cache.remove_checkout(self.repo_path)
+        self.cache.release(self.clone_url)
+        self.cloned_repo = None
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop the cached index, the next access walks the working tree again."""
+        self._index = None
 
     def get_all(self, f = None) -> List[RepoFile]:
-        r = []
-        def dfs(node: RepoFile):
-            if f is None or f(node):
-                r.append(node)
-            for entry in node.entries:
-                dfs(entry)
-        dfs(self.root)
-        return r
+        if f is None:
+            return list(self.index.all)
+        return list(filter(f, self.index.all))
+
+    @property
+    def clone_url(self) -> str:
+        """Clone URL of the GitHub repository, other URLs (another host, file://) are cloned as given."""
+        return self.repo.clone_url if self.repo is not None else self.url
+
+    @property
+    def head_sha(self) -> Optional[str]:
+        return self.cloned_repo.head.commit.hexsha if self.cloned_repo is not None else None
+
+    @property
+    def _is_shallow(self) -> bool:
+        return self.cloned_repo.git.rev_parse("--is-shallow-repository") == "true"
+
+    @property
+    def index(self) -> RepoIndex:
+        if self._index is None:
+            if self.cloned_repo is not None and self.cloned_repo.bare:
+                tree = self.cloned_repo.head.commit.tree
+                def read(relpath: str) -> Optional[bytes]:
+                    try:
+                        return (tree / relpath).data_stream.read()
+                    except KeyError:
+                        return None
+                self.ignore = IgnoreEngine.default(read, self.max_file_size)
+                self._index = RepoIndex.from_tree(tree, skip=self.ignore)
+            else:
+                def read(relpath: str) -> Optional[bytes]:
+                    path = self.repo_path / relpath
+                    return path.read_bytes() if path.is_file() else None
+                self.ignore = IgnoreEngine.default(read, self.max_file_size)
+                self._index = RepoIndex.from_path(self.repo_path, skip=self.ignore)
+        return self._index
 
     @property
     def root(self) -> RepoFile:
-        return RepoFile(self.repo_path)
+        return self.index.root
     
     @property
     def readme(self) -> Optional[RepoFile]:
-        filtered = list(filter(lambda x: "README" in x.path, self.files))
-        filtered.sort(key=lambda x: len(x.path))
-        return filtered[0] if len(filtered) > 0 else None
+        return self.index.readme
     
     @property
     def all(self) -> List[RepoFile]:
-        return self.get_all()
+        return list(self.index.all)
 
     @property
     def directories(self) -> List[RepoFile]:
-        return self.get_all(lambda f: f.is_dir)
+        return list(self.index.directories)
     
     @property
     def files(self) -> List[RepoFile]:
-        return self.get_all(lambda f: f.is_file)
+        return list(self.index.files)
 
     @staticmethod
     def extract_id(url: str) -> Optional[str]:
@@ -0,0 +1,210 @@
+import json
+import os
+from array import array
+from typing import Callable, Iterator, Optional, TextIO, Type, TypeVar
+from git import Tree
+
+DIR_TYPE = "dir"
+OID_SIZE = 20
+
+# skip(relpath, is_dir, size) -> True when the entry (and for directories its whole subtree) is left out
+SkipFn = Callable[[str, bool, int], bool]
+
+def _scandir_sorted(path: str) -> Iterator[os.DirEntry]:
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    return iter(entries)
+
+def _join(relpath: str, name: str) -> str:
+    return name if relpath == "." else f"{relpath}/{name}"
+
+T = TypeVar('T', bound='RepoTree')
+class RepoTree:
+    """
+    Array-backed repository tree. Nodes are numbered in pre-order with the root at 0, so the
+    subtree of node i is the range [i, end(i)). Per node we only keep a name offset into one
+    shared byte buffer, the parent index, the size, an interned type id and, for trees read
+    from git, the 20 byte object id.
+    """
+    __slots__ = (
+        "_names", "_name_offsets", "_parents", "_ends", "_sizes",
+        "_types", "_type_names", "_type_ids", "_oids",
+        "_root_path", "_odb", "_relpaths"
+    )
+
+    @classmethod
+    def from_path(cls: Type[T], path: str, skip: Optional[SkipFn] = None) -> T:
+        root_path = os.path.abspath(path)
+        tree = cls(root_path=root_path)
+        root = tree._add(os.path.basename(root_path), -1, os.stat(root_path).st_size, DIR_TYPE)
+        stack = [(root, ".", _scandir_sorted(root_path))]
+        while stack:
+            parent, relpath, it = stack[-1]
+            entry = next(it, None)
+            if entry is None:
+                tree._close(parent)
+                stack.pop()
+                continue
+            child_relpath = _join(relpath, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                size = entry.stat(follow_symlinks=False).st_size
+                if skip is not None and skip(child_relpath, True, size):
+                    continue
+                idx = tree._add(entry.name, parent, size, DIR_TYPE)
+                stack.append((idx, child_relpath, _scandir_sorted(entry.path)))
+            elif entry.is_file():
+                size = entry.stat().st_size
+                if skip is not None and skip(child_relpath, False, size):
+                    continue
+                tree._add(entry.name, parent, size, os.path.splitext(entry.name)[1])
+        return tree
+
+    @classmethod
+    def from_git_tree(cls: Type[T], git_tree: Tree, skip: Optional[SkipFn] = None) -> T:
+        tree = cls(odb=git_tree.repo.odb)
+        root = tree._add("", -1, 0, DIR_TYPE, git_tree.binsha)
+
+        def children(t: Tree):
+            return iter(sorted(t.trees + t.blobs, key=lambda o: o.name))
+
+        stack = [(root, ".", children(git_tree))]
+        while stack:
+            parent, relpath, it = stack[-1]
+            obj = next(it, None)
+            if obj is None:
+                tree._close(parent)
+                stack.pop()
+                continue
+            child_relpath = _join(relpath, obj.name)
+            if obj.type == "tree":
+                if skip is not None and skip(child_relpath, True, 0):
+                    continue
+                idx = tree._add(obj.name, parent, 0, DIR_TYPE, obj.binsha)
+                stack.append((idx, child_relpath, children(obj)))
+            elif obj.mode & 0o170000 == 0o100000:   # regular files, no symlinks or submodules
+                if skip is not None and skip(child_relpath, False, obj.size):
+                    continue
+                tree._add(obj.name, parent, obj.size, os.path.splitext(obj.name)[1], obj.binsha)
+        return tree
+
+    def __init__(self, root_path: Optional[str] = None, odb = None):
+        self._names = bytearray()
+        self._name_offsets = array("Q", [0])
+        self._parents = array("i")
+        self._ends = array("I")
+        self._sizes = array("Q")
+        self._types = array("H")
+        self._type_names = [DIR_TYPE]
+        self._type_ids = {DIR_TYPE: 0}
+        self._oids = bytearray()
+        self._root_path = root_path
+        self._odb = odb
+        self._relpaths = None
+
+    def __len__(self) -> int:
+        return len(self._parents)
+
+    def _add(self, name: str, parent: int, size: int, type: str, oid: bytes = b"") -> int:
+        idx = len(self._parents)
+        self._names += os.fsencode(name)
+        self._name_offsets.append(len(self._names))
+        self._parents.append(parent)
+        self._ends.append(idx + 1)
+        self._sizes.append(size)
+        type_id = self._type_ids.get(type)
+        if type_id is None:
+            type_id = len(self._type_names)
+            self._type_names.append(type)
+            self._type_ids[type] = type_id
+        self._types.append(type_id)
+        if self._odb is not None:
+            self._oids += oid
+        return idx
+
+    def _close(self, idx: int):
+        self._ends[idx] = len(self._parents)
+
+    def name(self, idx: int) -> str:
+        return os.fsdecode(bytes(self._names[self._name_offsets[idx]:self._name_offsets[idx + 1]]))
+
+    def parent(self, idx: int) -> int:
+        return self._parents[idx]
+
+    def end(self, idx: int) -> int:
+        return self._ends[idx]
+
+    def size(self, idx: int) -> int:
+        return self._sizes[idx]
+
+    def type(self, idx: int) -> str:
+        return self._type_names[self._types[idx]]
+
+    def is_dir(self, idx: int) -> bool:
+        return self._types[idx] == 0
+
+    def children(self, idx: int) -> Iterator[int]:
+        i = idx + 1
+        end = self._ends[idx]
+        while i < end:
+            yield i
+            i = self._ends[i]
+
+    def relpath(self, idx: int) -> str:
+        parts = []
+        while idx > 0:
+            parts.append(self.name(idx))
+            idx = self._parents[idx]
+        return "/".join(reversed(parts)) if parts else "."
+
+    def path(self, idx: int) -> str:
+        if self._root_path is None:
+            return self.relpath(idx)
+        return os.path.join(self._root_path, self.relpath(idx)) if idx > 0 else self._root_path
+
+    def hexsha(self, idx: int) -> Optional[str]:
+        if self._odb is None:
+            return None
+        return self._oids[idx * OID_SIZE:(idx + 1) * OID_SIZE].hex()
+
+    def find(self, relpath: str) -> Optional[int]:
+        """Node index of a relative path. The lookup table is built on first use."""
+        if self._relpaths is None:
+            self._relpaths = {self.relpath(i): i for i in range(len(self))}
+        return self._relpaths.get(relpath)
+
+    def read(self, idx: int) -> bytes:
+        assert not self.is_dir(idx)
+        if self._odb is not None:
+            return self._odb.stream(bytes(self._oids[idx * OID_SIZE:(idx + 1) * OID_SIZE])).read()
+        with open(self.path(idx), "rb") as f:
+            return f.read()
+
+    def iter_json(self, idx: int = 0) -> Iterator[str]:
+        """
+        JSON of the subtree in the layout of RepoFile.to_dict, produced node by node
+        without materialising the nested dicts.
+        """
+        end = self._ends[idx]
+        open_dirs = []
+        for i in range(idx, end):
+            while open_dirs and open_dirs[-1] <= i:
+                open_dirs.pop()
+                yield "]}"
+            if i != idx and self._parents[i] + 1 != i:
+                yield ", "
+            is_dir = self.is_dir(i)
+            yield (
+                f'{{"path": {json.dumps(self.path(i))}, "name": {json.dumps(self.name(i))}, '
+                f'"type": {json.dumps(self.type(i))}, "size": {self._sizes[i]}, '
+                f'"is_dir": {"true" if is_dir else "false"}, "entries": ['
+            )
+            if self._ends[i] == i + 1:
+                yield "]}"
+            else:
+                open_dirs.append(self._ends[i])
+        for _ in open_dirs:
+            yield "]}"
+
+    def write_json(self, fp: TextIO, idx: int = 0):
+        for s in self.iter_json(idx):
+            fp.write(s)
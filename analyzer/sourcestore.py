@@ -0,0 +1,50 @@
+from hashlib import sha1
+from typing import Iterable
+
+class Span:
+    """Byte range of a source file, `file` is the git blob sha of the file content."""
+    __slots__ = ("file", "start_byte", "end_byte", "start_line", "end_line")
+
+    def __init__(self, file: str, start_byte: int, end_byte: int, start_line: int, end_line: int):
+        self.file = file
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.start_line = start_line    # 1-based, inclusive
+        self.end_line = end_line
+
+    def __len__(self) -> int:
+        return self.end_byte - self.start_byte
+
+    def __repr__(self) -> str:
+        return f"Span({self.file[:8]}, {self.start_byte}:{self.end_byte}, lines {self.start_line}-{self.end_line})"
+
+class SourceStore:
+    """
+    Contents of the parsed files by blob sha, shared by every span of a build, so files
+    with identical content are kept once. Text is decoded from the stored bytes on request.
+    """
+    def __init__(self):
+        self._sources = {}
+
+    def add(self, file: str, source: bytes):
+        self._sources.setdefault(file, source)
+
+    def add_codes(self, codes: Iterable):
+        for code in codes:
+            self.add(code.sha, code.source)
+
+    def source(self, file: str) -> bytes:
+        return self._sources[file]
+
+    def view(self, span: Span) -> memoryview:
+        return memoryview(self._sources[span.file])[span.start_byte:span.end_byte]
+
+    def text(self, span: Span) -> str:
+        return str(self.view(span), "utf-8")
+
+    def hash(self, span: Span) -> str:
+        """Same as parsing.body_hash of the text, without decoding it."""
+        return sha1(self.view(span)).hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._sources)
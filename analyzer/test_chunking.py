@@ -0,0 +1,63 @@
+import chunking
+from chunking import definition_blocks
+from parsing import parse_source
+from sourcestore import SourceStore
+
+def words(s: str) -> int:
+    return len(s.split())
+
+def oversized_if() -> bytes:
+    body = "".join(f"            total += {i}\n" for i in range(60))
+    return (
+        "def outer(flag):\n"
+        "    total = 0\n"
+        "    if flag:\n"
+        "        def inner(x):\n"
+        "            total = x\n"
+        f"{body}"
+        "            return total\n"
+        "        total = inner(1)\n"
+        "    return total\n"
+    ).encode()
+
+def test_oversized_compound_statement_keeps_source_lines(monkeypatch):
+    monkeypatch.setattr(chunking, "count_tokens", words)
+    code = oversized_if()
+    chunk = parse_source(code, "mod.py", "mod.py")
+    store = SourceStore()
+    store.add(chunk.sha, chunk.source)
+    lines = code.decode().splitlines(keepends=True)
+
+    blocks = definition_blocks(chunk.functions[0], store, max_tokens=40)
+    assert len(blocks) > 2
+    for text, start, end in blocks:
+        assert text.rstrip("\n") == "".join(lines[start - 1:end]).rstrip("\n")
+    assert blocks[0][1] == 1 and blocks[-1][2] == len(lines)
+    assert all(prev[2] + 1 == block[1] for prev, block in zip(blocks, blocks[1:]))
+
+def test_collapsed_method_keeps_source_lines(monkeypatch):
+    monkeypatch.setattr(chunking, "count_tokens", words)
+    arguments = "".join(f"        option_{i}=True,\n" for i in range(120))
+    body = "".join(f"        x += {i}\n" for i in range(30))
+    code = (
+        "class Config:\n"
+        "    @settings(\n"
+        f"{arguments}"
+        "    )\n"
+        "    def load(self):\n"
+        "        x = 0\n"
+        f"{body}"
+        "        return x\n"
+    ).encode()
+    chunk = parse_source(code, "mod.py", "mod.py")
+    store = SourceStore()
+    store.add(chunk.sha, chunk.source)
+    lines = code.decode().splitlines(keepends=True)
+
+    blocks = definition_blocks(chunk.classes[0], store, max_tokens=40)
+    assert len(blocks) > 2
+    assert blocks[-1][0].endswith("def load(self):\n        ...")
+    assert (blocks[-1][2]) == len(lines)
+    for text, start, end in blocks[:-1]:
+        assert text.rstrip("\n") == "".join(lines[start - 1:end]).rstrip("\n")
+    assert all(prev[2] + 1 == block[1] for prev, block in zip(blocks, blocks[1:]))
@@ -0,0 +1,30 @@
+import os
+import numpy as np
+import pytest
+from embedder import Embedder, OnnxEmbedder, MODEL_PATH
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("sentence_transformers")
+
+PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), MODEL_PATH)
+# same threshold as `benchmark.py onnx`
+MIN_COSINE = 0.98
+
+SNIPPETS = [
+    "Function 'parse' parses every parsable file of the repository into code chunks.",
+    "Class 'CloneCache' keeps one bare mirror per repository URL shared by analyzer workers.",
+    "Returns the nearest records of every query, best first, merged by reciprocal rank fusion.",
+    "def add(a, b):\n    return a + b",
+    "Reads the README of the repository and stores it in redis.",
+]
+
+@pytest.mark.skipif(
+    not any(os.path.exists(os.path.join(PATH, name)) for name in ("model.safetensors", "pytorch_model.bin")),
+    reason="model weights are not downloaded"
+)
+def test_onnx_int8_matches_torch():
+    a = Embedder(PATH).encode(SNIPPETS)
+    b = OnnxEmbedder(PATH).encode(SNIPPETS)
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    assert cosine.min() >= MIN_COSINE
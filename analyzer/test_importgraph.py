@@ -0,0 +1,20 @@
+from importgraph import ImportGraph
+from parsing import CodeChunk, Import
+
+def code(path: str, *imports: Import) -> CodeChunk:
+    return CodeChunk(path, path.split("/")[-1], list(imports), [], [])
+
+def test_added_module_resolves_unchanged_importer():
+    app = code("app/main.py", Import("pkg.tools", "", []))
+    graph = ImportGraph.from_codes([app, code("pkg/__init__.py")])
+    assert graph.imports["app/main.py"] == set()
+
+    graph.update([code("pkg/tools.py")])
+    assert graph.imports["app/main.py"] == {"pkg/tools.py"}
+
+    graph.update([code("pkg/helpers.py")], removed=["pkg/tools.py"])
+    assert graph.imports["app/main.py"] == set()
+
+def test_stdlib_name_does_not_resolve_to_script():
+    graph = ImportGraph.from_codes([code("scripts/run.py", Import("logging", "", [])), code("scripts/logging.py")])
+    assert graph.imports["scripts/run.py"] == set()
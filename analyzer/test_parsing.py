@@ -0,0 +1,44 @@
+from pathlib import Path
+from git import Actor, Repo
+from parsing import TreeCache, parse_incremental, touched
+from repo import Repository
+
+BEFORE = '''import os
+
+def first():
+    return 1
+
+def second():
+    return 2
+
+def third():
+    return 3
+'''
+
+AFTER = BEFORE.replace("return 2", "value = 2\n    return value")
+
+def commit(work: Repo, content: str):
+    (Path(work.working_tree_dir) / "mod.py").write_text(content)
+    work.index.add(["mod.py"])
+    author = Actor("test", "test@example.com")
+    work.index.commit("change", author=author, committer=author)
+
+def test_update_after_build_only_touches_edited_function(tmp_path):
+    work = Repo.init(tmp_path / "work")
+    commit(work, BEFORE)
+    repo = Repository(f"file://{tmp_path / 'work'}", repo_path=str(tmp_path / "checkout"))
+    repo.clone()
+    old = repo.head_sha
+
+    commit(work, AFTER)
+    repo.pull()
+    hunks = repo.diff_hunks(old, repo.head_sha, ["mod.py"])
+    old_sha, file_hunks = hunks["mod.py"]
+
+    # nothing was parsed incrementally before, like the first update after a build or a restart
+    trees = TreeCache(load=repo.read_blob)
+    file = repo.index.get("mod.py")
+    code, changed = parse_incremental(file.read("rb"), file.relpath, file.name, old_sha, file_hunks, trees)
+
+    assert changed is not None
+    assert [f.name for f in code.functions if touched(f, changed)] == ["second"]
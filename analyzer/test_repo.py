@@ -0,0 +1,75 @@
+import pytest
+from git import Actor, Repo
+from clonecache import CloneCache
+from repo import CloneMode, Repository
+
+FILES = {
+    "README.md": "# demo\n",
+    "setup.py": "print('setup')\n",
+    "pkg/__init__.py": "",
+    "pkg/mod.py": "def f():\n    return 1\n",
+    "data/table.csv": "a,b\n1,2\n",
+}
+
+@pytest.fixture
+def origin(tmp_path) -> str:
+    """file:// URL of a bare repository with one commit, serving partial clones like GitHub does."""
+    work = Repo.init(tmp_path / "work")
+    for relpath, content in FILES.items():
+        path = tmp_path / "work" / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    work.index.add(list(FILES))
+    author = Actor("test", "test@example.com")
+    work.index.commit("initial", author=author, committer=author)
+    bare = work.clone(tmp_path / "origin.git", bare=True)
+    bare.git.config("uploadpack.allowFilter", "true")
+    return f"file://{tmp_path / 'origin.git'}"
+
+def relpaths(repo: Repository) -> set[str]:
+    return {file.relpath for file in repo.files}
+
+def test_sparse_clone(origin, tmp_path):
+    repo = Repository(origin, CloneMode.SPARSE, repo_path=str(tmp_path / "checkout"))
+    repo.clone()
+    assert repo.cloned_repo.git.rev_parse("--is-shallow-repository") == "true"
+    assert relpaths(repo) == {"README.md", "setup.py", "pkg/__init__.py", "pkg/mod.py"}
+    assert not (tmp_path / "checkout" / "data").exists()
+
+def test_bare_clone(origin, tmp_path):
+    repo = Repository(origin, CloneMode.BARE, repo_path=str(tmp_path / "checkout"))
+    repo.clone()
+    assert repo.cloned_repo.bare
+    assert relpaths(repo) == set(FILES)
+    assert repo.index.get("pkg/mod.py").read() == FILES["pkg/mod.py"]
+
+@pytest.mark.parametrize("mode", [CloneMode.FULL, CloneMode.SPARSE])
+def test_cached_checkout(origin, tmp_path, mode):
+    cache = CloneCache(str(tmp_path / "cache"))
+    dest = cache.checkout_path("analyzer")
+    repo = Repository(origin, mode, repo_path=str(dest), cache=cache)
+    repo.clone()
+    assert cache.mirror_path(origin).exists()
+    assert repo.head_sha == Repo(cache.mirror_path(origin)).head.commit.hexsha
+    expected = set(FILES) if mode == CloneMode.FULL else set(FILES) - {"data/table.csv"}
+    assert relpaths(repo) == expected
+
+    repo.close()
+    assert not dest.exists()
+    assert CloneCache.key(origin) not in cache._leases
+
+def test_cached_bare(origin, tmp_path):
+    cache = CloneCache(str(tmp_path / "cache"))
+    repo = Repository(origin, CloneMode.BARE, repo_path=str(tmp_path / "unused"), cache=cache)
+    repo.clone()
+    assert repo.repo_path == cache.mirror_path(origin)
+    assert CloneCache.key(origin) in cache._leases
+    assert relpaths(repo) == set(FILES)
+
+    # a second clone fetches into the existing mirror
+    other = Repository(origin, CloneMode.BARE, repo_path=str(tmp_path / "unused"), cache=cache)
+    other.clone()
+    assert other.head_sha == repo.head_sha
+
+    repo.close()
+    assert CloneCache.key(origin) not in cache._leases
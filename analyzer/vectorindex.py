@@ -0,0 +1,85 @@
+import os
+import numpy as np
+from typing import Optional, Type, TypeVar
+from redis.commands.search.field import VectorField
+
+ALGORITHMS = ("auto", "flat", "hnsw")
+# element types of stored vectors, packed little-endian
+VECTOR_TYPES = {
+    "FLOAT32": np.dtype("<f4"),
+    "FLOAT16": np.dtype("<f2"),
+}
+# up to this many records a brute force scan is fast enough and exact
+FLAT_MAX_RECORDS = 50*1000
+
+T = TypeVar('T', bound='VectorIndexConfig')
+class VectorIndexConfig:
+    """
+    Algorithm of the vector field of a code index. `auto` picks FLAT for repositories up to
+    `flat_max_records` records and HNSW above. `m` and `ef_construction` shape the HNSW graph,
+    `ef_runtime` is the candidate list of a KNN query, higher values trade latency for recall.
+    `vector_type` is FLOAT32, or FLOAT16 for half the memory (needs RediSearch 2.10).
+    The choices are made when the index is created, updates keep those of the index.
+    """
+    @classmethod
+    def from_env(cls: Type[T]) -> T:
+        return cls(
+            algorithm=(os.getenv("VECTOR_INDEX_ALGORITHM") or "auto").lower(),
+            m=int(os.getenv("HNSW_M") or 16),
+            ef_construction=int(os.getenv("HNSW_EF_CONSTRUCTION") or 200),
+            ef_runtime=int(os.getenv("HNSW_EF_RUNTIME") or 64),
+            flat_max_records=int(os.getenv("VECTOR_INDEX_FLAT_MAX_RECORDS") or FLAT_MAX_RECORDS),
+            vector_type=(os.getenv("VECTOR_TYPE") or "FLOAT32").upper()
+        )
+
+    def __init__(
+            self,
+            algorithm: str = "auto",
+            m: int = 16,
+            ef_construction: int = 200,
+            ef_runtime: int = 64,
+            flat_max_records: int = FLAT_MAX_RECORDS,
+            vector_type: str = "FLOAT32"
+    ):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"unknown vector index algorithm {algorithm}, expected one of {', '.join(ALGORITHMS)}")
+        if vector_type not in VECTOR_TYPES:
+            raise ValueError(f"unknown vector type {vector_type}, expected one of {', '.join(VECTOR_TYPES)}")
+        self.algorithm = algorithm
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_runtime = ef_runtime
+        self.flat_max_records = flat_max_records
+        self.vector_type = vector_type
+
+    def algorithm_for(self, records: int) -> str:
+        if self.algorithm != "auto":
+            return self.algorithm
+        return "flat" if records <= self.flat_max_records else "hnsw"
+
+    def field(
+            self,
+            path: str,
+            dim: int,
+            records: int,
+            vector_type: Optional[str] = None,
+            as_name: str = "embedding"
+    ) -> VectorField:
+        attributes = {
+            "TYPE": vector_type or self.vector_type,
+            "DIM": dim,
+            "DISTANCE_METRIC": "COSINE",
+        }
+        algorithm = self.algorithm_for(records)
+        if algorithm == "hnsw":
+            attributes.update({
+                "M": self.m,
+                "EF_CONSTRUCTION": self.ef_construction,
+                "EF_RUNTIME": self.ef_runtime,
+            })
+        return VectorField(path, algorithm.upper(), attributes, as_name=as_name)
+
+def pack(vectors: np.ndarray, vector_type: str) -> list[bytes]:
+    """Each row as a blob for a HASH field, straight from the numpy buffer."""
+    vectors = np.ascontiguousarray(vectors, dtype=VECTOR_TYPES[vector_type])
+    return [row.tobytes() for row in vectors]
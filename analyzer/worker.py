@@ -1,17 +1,38 @@
 from common.redis import get_redis
-from common.analyzer import Analyzer, AnalyzerStatus
+from common.analyzer import Analyzer, AnalyzerStatus, AnalyzerAction
 from common.query import QueryStatus, QueryResult
-from repo import Repository
+from repo import Repository, REPO_PATH
+from clonecache import CloneCache
+from parsecache import ParseCache
+from desccache import DescriptionCache
+from vectorindex import VectorIndexConfig
 from codedb import CodeDB
 from agent import Agent
 from time import sleep
+import signal
+import sys
 
 def main():
+    # docker stop sends SIGTERM, exit through the finally below so the checkout is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     query = None
+    repo = None
     try:
         analyzer = Analyzer.from_env()
-        repo = Repository(analyzer.github_url)
-        codedb = CodeDB(repo=repo)
+        cache = CloneCache.from_env()
+        repo = Repository(
+            analyzer.github_url,
+            clone_mode=analyzer.clone_mode,
+            repo_path=cache.checkout_path(analyzer.id) if cache is not None else REPO_PATH,
+            cache=cache
+        )
+        codedb = CodeDB(
+            repo=repo,
+            token_budget=analyzer.token_budget,
+            parse_cache=ParseCache.from_env(),
+            desc_cache=DescriptionCache.from_env(),
+            vector_index=VectorIndexConfig.from_env()
+        )
         agent = Agent(codedb)
 
         if not codedb.exists():
@@ -23,6 +44,16 @@ def main():
 
         analyzer.set_status(AnalyzerStatus.READY)
         while True:
+            action = analyzer.pull_action()
+            if action == AnalyzerAction.UPDATE:
+                analyzer.set_status(AnalyzerStatus.UPDATING)
+                if repo.cloned_repo is None:
+                    repo.clone()
+                repo.pull()
+                codedb.update(threads=8)
+                analyzer.set_status(AnalyzerStatus.READY)
+                continue
+
             query = analyzer.pull_query()
             if query is None:
                 sleep(1.0)
@@ -36,6 +67,9 @@ def main():
         if query is not None:
             query.set_status(QueryStatus.ERROR)
         raise e
+    finally:
+        if repo is not None:
+            repo.close()
     
 if __name__ == "__main__":
     main()
@@ -1,3 +1,4 @@
+import threading
 import uuid
 import docker as dk
 import os
@@ -6,6 +7,13 @@ from enum import Enum
 from .redis import get_redis
 from .query import Query, QueryStatus
 
+DEFAULT_CLONE_MODE = os.getenv("DEFAULT_CLONE_MODE", "full")
+# host directory shared by all workers as a clone cache, disabled when unset
+CLONE_CACHE_HOST_DIR = os.getenv("CLONE_CACHE_HOST_DIR")
+CLONE_CACHE_DIR = "/clone-cache"
+# seconds a worker gets to clean up before it is killed
+WORKER_STOP_TIMEOUT = 10
+
 def get_docker() -> dk.DockerClient:
     return dk.from_env()
 
@@ -16,22 +24,39 @@ def get_container(name: str):
     except dk.errors.NotFound:
         return None
 
+def _stop_container(container):
+    try:
+        container.stop(timeout=WORKER_STOP_TIMEOUT)
+    except dk.errors.NotFound:
+        pass
+
 class AnalyzerStatus(Enum):
     REQUESTED = "REQUESTED"
     SPAWNED = "SPAWNED"
     CLONING = "CLONING"
     PROCESSING = "PROCESSING"
+    UPDATING = "UPDATING"
     READY = "READY"
     ERROR = "ERROR"
 
+class AnalyzerAction(Enum):
+    UPDATE = "update"
+
 T = TypeVar('T', bound='Analyzer')
 
 class Analyzer:
     @classmethod
-    def new(cls: Type[T], github_url: str) -> T:
+    def new(
+        cls: Type[T],
+        github_url: str,
+        clone_mode: Optional[str] = None,
+        token_budget: Optional[int] = None
+    ) -> T:
         return Analyzer(
             github_url=github_url,
-            id=str(uuid.uuid4().hex)
+            id=str(uuid.uuid4().hex),
+            clone_mode=clone_mode,
+            token_budget=token_budget
         )
     
     @classmethod
@@ -46,16 +71,22 @@ class Analyzer:
         return Analyzer(
             github_url=os.getenv("GITHUB_URL"),
             id=os.getenv("REQUEST_ID"),
+            clone_mode=os.getenv("CLONE_MODE") or None,
+            token_budget=int(os.getenv("TOKEN_BUDGET")) if os.getenv("TOKEN_BUDGET") else None,
         )
 
     def __init__(
         self, 
         github_url: Optional[str] = None,
-        id: Optional[str] = None
+        id: Optional[str] = None,
+        clone_mode: Optional[str] = None,
+        token_budget: Optional[int] = None
     ):
         self.redis = get_redis()
         self.github_url = github_url
         self.id = id
+        self.clone_mode = clone_mode if clone_mode is not None else DEFAULT_CLONE_MODE
+        self.token_budget = token_budget
     
     def exists(self) -> bool:
         return self.redis.exists(self._status_key)
@@ -72,15 +103,36 @@ class Analyzer:
 
         docker = get_docker()
         network = docker.networks.get("llm_net")
+        volumes = {}
+        cache_env = []
+        if CLONE_CACHE_HOST_DIR:
+            volumes[CLONE_CACHE_HOST_DIR] = {"bind": CLONE_CACHE_DIR, "mode": "rw"}
+            cache_env = [
+                f"CLONE_CACHE_DIR={CLONE_CACHE_DIR}",
+                f"CLONE_CACHE_MAX_BYTES={os.environ.get('CLONE_CACHE_MAX_BYTES', '')}",
+                f"PARSE_CACHE_DIR={CLONE_CACHE_DIR}/parse",
+                f"PARSE_CACHE_MAX_BYTES={os.environ.get('PARSE_CACHE_MAX_BYTES', '')}",
+            ]
         container = docker.containers.run(
             "analyzer_worker",
             name=self._worker_name,
             detach=True,
             auto_remove=True,
             network="redis_net",
-            environment=[
+            volumes=volumes,
+            environment=cache_env + [
                 f"REQUEST_ID={self.id}",
                 f"GITHUB_URL={self.github_url}",
+                f"CLONE_MODE={self.clone_mode}",
+                f"TOKEN_BUDGET={self.token_budget if self.token_budget is not None else ''}",
+                f"DESC_CACHE_TTL={os.environ.get('DESC_CACHE_TTL', '')}",
+                f"EMBED_BATCH_SIZE={os.environ.get('EMBED_BATCH_SIZE', '')}",
+                f"EMBEDDING_BACKEND={os.environ.get('EMBEDDING_BACKEND', '')}",
+                f"VECTOR_INDEX_ALGORITHM={os.environ.get('VECTOR_INDEX_ALGORITHM', '')}",
+                f"HNSW_M={os.environ.get('HNSW_M', '')}",
+                f"HNSW_EF_CONSTRUCTION={os.environ.get('HNSW_EF_CONSTRUCTION', '')}",
+                f"HNSW_EF_RUNTIME={os.environ.get('HNSW_EF_RUNTIME', '')}",
+                f"VECTOR_TYPE={os.environ.get('VECTOR_TYPE', '')}",
                 f"REDIS_HOST={self.redis.connection_pool.connection_kwargs['host']}",
                 f"REDIS_PORT={self.redis.connection_pool.connection_kwargs['port']}",
                 f"LLM_API_KEY={os.environ.get('LLM_API_KEY', 'API_KEY')}"
@@ -100,10 +152,19 @@ class Analyzer:
         else:
             return None
 
+    def push_action(self, action: AnalyzerAction):
+        self.redis.rpush(self._action_queue_name, action.value)
+    
+    def pull_action(self) -> Optional[AnalyzerAction]:
+        s = self.redis.lpop(name=self._action_queue_name)
+        return AnalyzerAction(s) if s is not None else None
+
     def delete(self):
         container = get_container(self._worker_name)
         if container:
-            container.remove(force=True)
+            # SIGTERM first so the worker removes its clone cache checkout, SIGKILL after the timeout.
+            # Stopping waits for the worker, so it runs in the background, the container is auto-removed
+            threading.Thread(target=_stop_container, args=(container,), daemon=True).start()
         self.delete_records()
     
     def delete_records(self):
@@ -129,5 +190,8 @@ class Analyzer:
     def _queue_name(self) -> str:
         return f"{self._redis_prefix}queue"
     @property
+    def _action_queue_name(self) -> str:
+        return f"{self._redis_prefix}actions"
+    @property
     def _query_list_name(self) -> str:
         return f"{self._redis_prefix}querylist"
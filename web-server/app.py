@@ -1,8 +1,9 @@
 from fastapi import FastAPI, HTTPException, Query, Body
 from fastapi.responses import JSONResponse, Response
-from common.analyzer import Analyzer, AnalyzerStatus, Query, QueryStatus
+from common.analyzer import Analyzer, AnalyzerStatus, AnalyzerAction, Query, QueryStatus
 from urllib.parse import unquote
 from pydantic import BaseModel
+from typing import Optional
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -20,8 +21,12 @@ app.add_middleware(
 
 class CreateAnalyzerDTO(BaseModel):
     github_url: str
+    clone_mode: Optional[str] = None  # "full", "sparse" or "bare", server default when omitted
+    token_budget: Optional[int] = None  # LLM input tokens for descriptions, unlimited when omitted
 
 
+CLONE_MODES = ("full", "sparse", "bare")
+
 # keeping track of analyzers so i can get rid of them all when i want
 analyzers = {}
 
@@ -30,7 +35,15 @@ analyzers = {}
 def create_analyze(
     dto: CreateAnalyzerDTO = Body(description="GitHub repository URL to analyze"),
 ):
-    analyzer = Analyzer.new(unquote(dto.github_url))
+    if dto.clone_mode is not None and dto.clone_mode not in CLONE_MODES:
+        raise HTTPException(status_code=400, detail="Unknown clone mode")
+    if dto.token_budget is not None and dto.token_budget < 0:
+        raise HTTPException(status_code=400, detail="Token budget must not be negative")
+    analyzer = Analyzer.new(
+        unquote(dto.github_url),
+        clone_mode=dto.clone_mode,
+        token_budget=dto.token_budget
+    )
     analyzer.set_status(AnalyzerStatus.REQUESTED)
     analyzer.spawn_container()
     analyzer.set_status(AnalyzerStatus.SPAWNED)
@@ -51,6 +64,17 @@ def progress(analyzer_id: str):
     )
 
 
+@app.post("/analyzer/{analyzer_id}/update")
+def update_analyzer(analyzer_id: str):
+    analyzer = Analyzer.from_id(analyzer_id)
+    if not analyzer.exists():
+        raise HTTPException(status_code=404, detail="Analyzer not found")
+    if analyzer.get_status() != AnalyzerStatus.READY:
+        raise HTTPException(status_code=400, detail="Analyzer is not Ready")
+    analyzer.push_action(AnalyzerAction.UPDATE)
+    return JSONResponse({"analyzer_id": analyzer_id}, status_code=202)
+
+
 @app.delete("/analyzer/{analyzer_id}")
 def delete_analyzer(analyzer_id: str):
     analyzer = Analyzer.from_id(analyzer_id)